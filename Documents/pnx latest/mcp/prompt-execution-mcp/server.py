@@ -4,9 +4,19 @@ Prompt Execution MCP Server
 Provides tools for prompt execution and workflow orchestration.
 """
 
+import ast
 import asyncio
+import csv
+import hashlib
 import json
-from typing import Any, Optional, Dict, List
+import math
+import os
+import re
+import sqlite3
+import time
+from collections import ChainMap, OrderedDict, deque
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterator, Optional, Dict, List
 
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
@@ -15,9 +25,228 @@ from mcp.types import Tool, TextContent
 # Initialize MCP server
 server = Server("prompt-execution-mcp")
 
-# Workflow storage (in-memory, can be replaced with database)
-workflows: Dict[str, dict] = {}
-execution_history: List[dict] = []
+# Compiled templates kept in the LRU render cache
+TEMPLATE_CACHE_SIZE = int(os.getenv("PROMPT_TEMPLATE_CACHE_SIZE", "1024"))
+
+# Compiled condition/transform expressions kept in their LRU cache
+EXPRESSION_CACHE_SIZE = int(os.getenv("PROMPT_EXPRESSION_CACHE_SIZE", "1024"))
+
+# Memoized workflow step results (LRU, keyed by step definition and inputs)
+STEP_CACHE_SIZE = int(os.getenv("PROMPT_STEP_CACHE_SIZE", "4096"))
+
+# Steps of one workflow execution that may run at the same time
+WORKFLOW_CONCURRENCY = int(os.getenv("PROMPT_WORKFLOW_CONCURRENCY", "8"))
+
+# Workflow executions slower than this many ms include a flame-style profile; empty disables
+SLOW_WORKFLOW_MS: Optional[float] = float(os.environ["PROMPT_SLOW_WORKFLOW_MS"]) if os.getenv("PROMPT_SLOW_WORKFLOW_MS") else None
+if SLOW_WORKFLOW_MS is not None and not 0 <= SLOW_WORKFLOW_MS < math.inf:
+    raise ValueError(f"PROMPT_SLOW_WORKFLOW_MS must be a non-negative number of milliseconds, not {SLOW_WORKFLOW_MS}")
+
+# Measure step input/output sizes (JSON bytes) on every execution, not only profiled ones; empty disables
+PROFILE_SIZES = bool(os.getenv("PROMPT_PROFILE_SIZES", ""))
+
+# Distinct text pieces whose token counts are cached by the token estimator
+TOKEN_VOCABULARY_SIZE = int(os.getenv("PROMPT_TOKEN_VOCABULARY_SIZE", "200000"))
+
+# Durable state (SQLite in PROMPT_DATA_DIR); empty keeps everything in memory
+PROMPT_DATA_DIR = os.getenv("PROMPT_DATA_DIR", "")
+
+# Executions kept in the in-memory history when there is no PROMPT_DATA_DIR
+HISTORY_MEMORY_SIZE = int(os.getenv("PROMPT_HISTORY_MEMORY_SIZE", "1000"))
+
+# Compiled workflow plans kept in memory (stored workflows are compiled on first execution)
+WORKFLOW_PLAN_CACHE_SIZE = int(os.getenv("PROMPT_WORKFLOW_PLAN_CACHE_SIZE", "256"))
+
+
+def open_database() -> Optional[sqlite3.Connection]:
+    """SQLite database in PROMPT_DATA_DIR (None when running memory-only)"""
+    if not PROMPT_DATA_DIR:
+        return None
+    Path(PROMPT_DATA_DIR).mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(str(Path(PROMPT_DATA_DIR) / "prompt.sqlite3"))
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class ExecutionHistory:
+    """Executions in an append-only SQLite log, or a fixed-size ring buffer without one
+
+    Every entry gets an increasing sequence number and a timestamp. With a
+    database every entry is appended to the log, indexed by workflow_id and
+    time, and nothing is kept in memory. Without one only the last max_recent
+    entries are kept, so memory stays constant either way.
+    """
+
+    def __init__(self, db: Optional[sqlite3.Connection] = None, max_recent: int = HISTORY_MEMORY_SIZE):
+        self._db = db
+        self._recent: Optional[deque] = deque(maxlen=max_recent) if db is None else None
+        self._next_seq = 1
+        if db is not None:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "seq INTEGER PRIMARY KEY, timestamp REAL NOT NULL, type TEXT NOT NULL, workflow_id TEXT, entry TEXT NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS history_workflow ON history (workflow_id, seq)")
+            db.execute("CREATE INDEX IF NOT EXISTS history_time ON history (timestamp)")
+            db.commit()
+            last = db.execute("SELECT MAX(seq) FROM history").fetchone()[0]
+            self._next_seq = (last or 0) + 1
+
+    def __len__(self) -> int:
+        return self._next_seq - 1
+
+    def append(self, entry: dict) -> int:
+        """Record an execution, returning its sequence number"""
+        record = {"seq": self._next_seq, "timestamp": time.time(), **entry}
+        self._next_seq += 1
+        if self._db is None:
+            self._recent.append(record)
+        else:
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO history (seq, timestamp, type, workflow_id, entry) VALUES (?, ?, ?, ?, ?)",
+                    (record["seq"], record["timestamp"], record["type"], record.get("workflow_id"), json.dumps(record)),
+                )
+        return record["seq"]
+
+    def page(
+        self,
+        workflow_id: Optional[str] = None,
+        entry_type: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        before: Optional[int] = None,
+        limit: int = 50,
+    ) -> tuple:
+        """Matching entries newest first, and the cursor (a sequence number) of the next page"""
+        if self._db is None:
+            entries = []
+            for record in reversed(self._recent):
+                if (
+                    (before is None or record["seq"] < before)
+                    and (workflow_id is None or record.get("workflow_id") == workflow_id)
+                    and (entry_type is None or record["type"] == entry_type)
+                    and (since is None or record["timestamp"] >= since)
+                    and (until is None or record["timestamp"] < until)
+                ):
+                    entries.append(record)
+                    if len(entries) > limit:
+                        break
+        else:
+            conditions, parameters = [], []
+            for clause, value in (
+                ("seq < ?", before),
+                ("workflow_id = ?", workflow_id),
+                ("type = ?", entry_type),
+                ("timestamp >= ?", since),
+                ("timestamp < ?", until),
+            ):
+                if value is not None:
+                    conditions.append(clause)
+                    parameters.append(value)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            rows = self._db.execute(
+                f"SELECT entry FROM history {where} ORDER BY seq DESC LIMIT ?", parameters + [limit + 1]
+            ).fetchall()
+            entries = [json.loads(row[0]) for row in rows]
+        next_cursor = entries[limit - 1]["seq"] if len(entries) > limit else None
+        return entries[:limit], next_cursor
+
+
+class WorkflowStore:
+    """Workflow definitions in memory, or in a SQLite table with summary columns
+
+    With a database, nothing is read at startup. Listing reads only the
+    indexed id/description columns and the step count, definitions are
+    loaded when a workflow is fetched, and plans are compiled on first
+    execution. Compiled plans are kept in a small LRU cache.
+    """
+
+    def __init__(self, db: Optional[sqlite3.Connection] = None, max_plans: int = WORKFLOW_PLAN_CACHE_SIZE):
+        self._db = db
+        self._workflows: Dict[str, dict] = {}
+        self._plans: "OrderedDict[str, WorkflowPlan]" = OrderedDict()
+        self.max_plans = max_plans
+        if db is not None:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS workflows ("
+                "id TEXT PRIMARY KEY, description TEXT NOT NULL, steps_count INTEGER NOT NULL, "
+                "definition TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS workflows_description ON workflows (description)")
+            db.commit()
+
+    def put(self, workflow: dict, plan: Optional["WorkflowPlan"] = None):
+        """Create or replace a workflow (and its compiled plan, if already built)"""
+        workflow_id = workflow["id"]
+        if self._db is None:
+            self._workflows[workflow_id] = workflow
+        else:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO workflows (id, description, steps_count, definition, updated) VALUES (?, ?, ?, ?, ?)",
+                    (workflow_id, workflow.get("description", ""), len(workflow["steps"]), json.dumps(workflow), time.time()),
+                )
+        self._plans.pop(workflow_id, None)
+        if plan is not None:
+            self._cache_plan(workflow_id, plan)
+
+    def get(self, workflow_id: str) -> dict:
+        if self._db is None:
+            workflow = self._workflows.get(workflow_id)
+        else:
+            row = self._db.execute("SELECT definition FROM workflows WHERE id = ?", (workflow_id,)).fetchone()
+            workflow = json.loads(row[0]) if row else None
+        if workflow is None:
+            raise ValueError(f"Workflow not found: {workflow_id}")
+        return workflow
+
+    def plan(self, workflow_id: str) -> "WorkflowPlan":
+        """Compiled plan of a workflow, built on first use"""
+        plan = self._plans.get(workflow_id)
+        if plan is not None:
+            self._plans.move_to_end(workflow_id)
+            return plan
+        plan = WorkflowPlan(self.get(workflow_id)["steps"])
+        self._cache_plan(workflow_id, plan)
+        return plan
+
+    def _cache_plan(self, workflow_id: str, plan: "WorkflowPlan"):
+        self._plans[workflow_id] = plan
+        if len(self._plans) > self.max_plans:
+            self._plans.popitem(last=False)
+
+    def summaries(self, query: Optional[str] = None, after: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+        """id, description and steps_count of workflows sorted by id, optionally filtered by a substring of either"""
+        if self._db is None:
+            summaries = [
+                {"id": wf["id"], "description": wf.get("description", ""), "steps_count": len(wf["steps"])}
+                for wf in self._workflows.values()
+                if (after is None or wf["id"] > after)
+                and (not query or query.lower() in wf["id"].lower() or query.lower() in wf.get("description", "").lower())
+            ]
+            summaries.sort(key=lambda summary: summary["id"])
+            return summaries if limit is None else summaries[:limit]
+        conditions, parameters = [], []
+        if after is not None:
+            conditions.append("id > ?")
+            parameters.append(after)
+        if query:
+            conditions.append("(id LIKE ? OR description LIKE ?)")
+            parameters.extend([f"%{query}%"] * 2)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self._db.execute(
+            f"SELECT id, description, steps_count FROM workflows {where} ORDER BY id LIMIT ?", parameters + [-1 if limit is None else limit]
+        ).fetchall()
+        return [{"id": row[0], "description": row[1], "steps_count": row[2]} for row in rows]
+
+
+database = open_database()
+
+# Workflow storage (in memory, or in the SQLite database when PROMPT_DATA_DIR is set)
+workflow_store = WorkflowStore(database)
+execution_history = ExecutionHistory(database)
 
 
 @server.list_tools()
@@ -33,6 +262,35 @@ async def list_tools() -> list[Tool]:
                     "prompt": {"type": "string", "description": "Prompt template"},
                     "variables": {"type": "object", "description": "Variables to substitute in prompt"},
                     "output_format": {"type": "string", "enum": ["text", "json", "structured"], "default": "text"},
+                    "count_tokens": {"type": "boolean", "description": "Report the estimated token count of the rendered prompt", "default": False},
+                    "max_tokens": {"type": "number", "description": "Truncate variables so the rendered prompt fits this many estimated tokens"},
+                    "truncate": {"type": "array", "items": {"type": "string"}, "description": "Variables that may be truncated (default: all)"},
+                },
+                "required": ["prompt"],
+            },
+        ),
+        Tool(
+            name="prompt_count_tokens",
+            description="Estimate token counts offline for one text or a batch of texts",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "text": {"type": "string", "description": "Text to count"},
+                    "texts": {"type": "array", "items": {"type": "string"}, "description": "Texts to count in one call"},
+                    "max_tokens": {"type": "number", "description": "Also list the indexes of texts over this budget"},
+                },
+            },
+        ),
+        Tool(
+            name="prompt_execute_batch",
+            description="Render one prompt template against many variable sets (an array, or a JSONL/CSV file)",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "prompt": {"type": "string", "description": "Prompt template"},
+                    "variables_list": {"type": "array", "items": {"type": "object"}, "description": "Variable sets to render"},
+                    "path": {"type": "string", "description": "JSONL file (one object per line) or CSV file with a header row"},
+                    "output_path": {"type": "string", "description": "Stream rendered prompts to this JSONL file instead of returning them"},
                 },
                 "required": ["prompt"],
             },
@@ -44,7 +302,11 @@ async def list_tools() -> list[Tool]:
                 "type": "object",
                 "properties": {
                     "workflow_id": {"type": "string", "description": "Unique workflow ID"},
-                    "steps": {"type": "array", "items": {"type": "object"}, "description": "Workflow steps"},
+                    "steps": {
+                        "type": "array",
+                        "items": {"type": "object"},
+                        "description": "Workflow steps; each may set an id and depends_on (ids of steps that must finish first). Types: prompt, condition, transform, map",
+                    },
                     "description": {"type": "string", "description": "Workflow description"},
                 },
                 "required": ["workflow_id", "steps"],
@@ -58,14 +320,50 @@ async def list_tools() -> list[Tool]:
                 "properties": {
                     "workflow_id": {"type": "string", "description": "Workflow ID to execute"},
                     "input_data": {"type": "object", "description": "Input data for workflow"},
+                    "concurrency": {"type": "number", "description": "Maximum steps running at once", "default": WORKFLOW_CONCURRENCY},
+                    "use_cache": {"type": "boolean", "description": "Reuse results of steps whose definition and inputs are unchanged", "default": True},
+                    "profile": {"type": "boolean", "description": "Include a flame-style breakdown (folded stacks, self time in µs) and step input/output sizes", "default": False},
                 },
                 "required": ["workflow_id"],
             },
         ),
+        Tool(
+            name="prompt_get_history",
+            description="Page through the execution history, newest first",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "workflow_id": {"type": "string", "description": "Only executions of this workflow"},
+                    "type": {"type": "string", "enum": ["prompt_execute", "prompt_execute_batch", "workflow_execute"], "description": "Only executions of this type"},
+                    "since": {"type": "number", "description": "Only executions at or after this Unix timestamp"},
+                    "until": {"type": "number", "description": "Only executions before this Unix timestamp"},
+                    "cursor": {"type": "string", "description": "next_cursor from the previous page"},
+                    "limit": {"type": "number", "description": "Entries per page", "default": 50},
+                },
+            },
+        ),
+        Tool(
+            name="prompt_get_stats",
+            description="Latency histograms (p50/p95/p99) per workflow and step type, queue wait, and cache statistics",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "workflow_id": {"type": "string", "description": "Only this workflow's histogram"},
+                    "reset": {"type": "boolean", "description": "Clear the histograms after reading them", "default": False},
+                },
+            },
+        ),
         Tool(
             name="prompt_list_workflows",
-            description="List all workflows",
-            inputSchema={},
+            description="List workflows (id, description, steps_count) sorted by id",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "Only workflows whose id or description contains this text"},
+                    "after": {"type": "string", "description": "Only workflows whose id sorts after this one (for paging)"},
+                    "limit": {"type": "number", "description": "Maximum number of workflows to return"},
+                },
+            },
         ),
         Tool(
             name="prompt_get_workflow",
@@ -81,39 +379,1059 @@ async def list_tools() -> list[Tool]:
     ]
 
 
-def substitute_variables(prompt: str, variables: dict) -> str:
-    """Substitute variables in prompt template"""
-    result = prompt
-    for key, value in variables.items():
-        result = result.replace(f"{{{key}}}", str(value))
+PLACEHOLDER_PATTERN = re.compile(r"\{([^{}]+)\}")
+
+
+class CompiledTemplate:
+    """A template parsed once into literal text and {variable} slots
+
+    Rendering fills the slots of a copy of the part list and joins it in one
+    pass, so substituted values are never scanned for placeholders again.
+    Placeholders without a matching variable are kept verbatim.
+    """
+
+    __slots__ = ("template", "variables", "_parts", "_slots")
+
+    def __init__(self, template: str):
+        self.template = template
+        self._parts: List[str] = []
+        self._slots: List[tuple] = []
+        position = 0
+        for match in PLACEHOLDER_PATTERN.finditer(template):
+            if match.start() > position:
+                self._parts.append(template[position:match.start()])
+            self._slots.append((len(self._parts), match.group(1)))
+            self._parts.append(match.group(0))
+            position = match.end()
+        if position < len(template):
+            self._parts.append(template[position:])
+        self.variables = list(dict.fromkeys(name for _, name in self._slots))
+
+    def render(self, variables: dict) -> str:
+        parts = self._parts.copy()
+        for slot, name in self._slots:
+            if name in variables:
+                parts[slot] = str(variables[name])
+        return "".join(parts)
+
+
+class CompileCache:
+    """LRU cache of compiled objects (templates, expressions) keyed by source text"""
+
+    def __init__(self, factory: Callable[[str], Any], max_size: int = TEMPLATE_CACHE_SIZE):
+        self.factory = factory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._compiled: "OrderedDict[str, Any]" = OrderedDict()
+
+    def get(self, source: str) -> Any:
+        compiled = self._compiled.get(source)
+        if compiled is not None:
+            self._compiled.move_to_end(source)
+            self.hits += 1
+            return compiled
+        self.misses += 1
+        compiled = self.factory(source)
+        self._compiled[source] = compiled
+        if len(self._compiled) > self.max_size:
+            self._compiled.popitem(last=False)
+        return compiled
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._compiled),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+template_cache = CompileCache(CompiledTemplate)
+
+
+EXPRESSION_CONSTANTS = {"true": True, "false": False, "null": None, "none": None}
+
+EXPRESSION_FUNCTIONS: Dict[str, Callable] = {
+    "len": len,
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": bool,
+    "abs": abs,
+    "round": round,
+    "min": min,
+    "max": max,
+    "sum": lambda items, start=0: _sum(items, start),
+    "any": any,
+    "all": all,
+    "sorted": sorted,
+    "unique": lambda items: list(dict.fromkeys(items)),
+    "lower": lambda text: str(text).lower(),
+    "upper": lambda text: str(text).upper(),
+    "keys": lambda mapping: list(mapping),
+    "values": lambda mapping: list(mapping.values()),
+}
+
+EXPRESSION_METHODS = {
+    str: {"lower", "upper", "strip", "lstrip", "rstrip", "title", "split", "join", "replace", "startswith", "endswith", "count", "find"},
+    dict: {"get", "keys", "values", "items"},
+    list: {"count", "index"},
+}
+
+COMPARE_OPERATORS = {
+    ast.Eq: lambda a, b: a == b,
+    ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b,
+    ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b,
+    ast.GtE: lambda a, b: a >= b,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+    ast.Is: lambda a, b: a is b,
+    ast.IsNot: lambda a, b: a is not b,
+}
+
+BINARY_OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: _multiply(a, b),
+    ast.Div: lambda a, b: a / b,
+    ast.FloorDiv: lambda a, b: a // b,
+    ast.Mod: lambda a, b: a % b,
+}
+
+UNARY_OPERATORS = {
+    ast.Not: lambda a: not a,
+    ast.USub: lambda a: -a,
+    ast.UAdd: lambda a: +a,
+}
+
+# Longest string or list any operation in an expression may build
+EXPRESSION_MAX_LENGTH = 1_000_000
+
+# Total length of the strings and lists built during one expression evaluation
+EXPRESSION_MAX_ELEMENTS = 10_000_000
+
+
+def _check_length(length: int) -> None:
+    if length > EXPRESSION_MAX_LENGTH:
+        raise ValueError(f"Expression result longer than {EXPRESSION_MAX_LENGTH}")
+
+
+def _sum(items: Any, start: Any) -> Any:
+    # sum() over lists or strings copies the running total on every item
+    if not isinstance(start, (int, float)) or isinstance(start, bool):
+        raise ValueError("sum() only adds numbers")
+    return sum(items, start)
+
+
+def _multiply(a: Any, b: Any) -> Any:
+    # Checked before multiplying, so an oversized repetition is never allocated
+    for sequence, count in ((a, b), (b, a)):
+        if isinstance(sequence, (str, list)) and isinstance(count, int):
+            _check_length(len(sequence) * count)
+    return a * b
+
+
+def _field(value: Any, name: Any) -> Any:
+    """value.name / value[name] on JSON data; missing fields and indexes are None"""
+    if isinstance(value, dict):
+        return value.get(name)
+    if isinstance(value, (list, str)) and isinstance(name, int) and not isinstance(name, bool):
+        return value[name] if -len(value) <= name < len(value) else None
+    return None
+
+
+def _call_method(value: Any, method: str, args: list) -> Any:
+    if method not in EXPRESSION_METHODS.get(type(value), ()):
+        raise ValueError(f"Unsupported method for {type(value).__name__}: {method}")
+    # Predict the growth of the two methods that can build long strings
+    if method == "replace" and len(args) >= 2 and isinstance(args[0], str) and isinstance(args[1], str):
+        _check_length(len(value) + value.count(args[0]) * max(0, len(args[1]) - len(args[0])))
+    elif method == "join" and isinstance(args[0] if args else None, list):
+        _check_length(sum(len(item) for item in args[0] if isinstance(item, str)) + len(value) * max(0, len(args[0]) - 1))
+    result = getattr(value, method)(*args)
+    if isinstance(result, (type({}.keys()), type({}.values()), type({}.items()))):
+        return [list(item) if isinstance(item, tuple) else item for item in result]
     return result
 
 
-async def execute_workflow_step(step: dict, context: dict) -> dict:
-    """Execute a single workflow step"""
+class Expression:
+    """A condition/transform expression compiled once into nested closures
+
+    The syntax is a safe subset of Python expressions over JSON data:
+    literals (plus true/false/null), context fields and paths (order.items[0].price,
+    order["key"]), arithmetic, comparisons, and/or/not, a if c else b, list and
+    object literals, whitelisted functions and string/dict methods, and list
+    comprehensions for map/filter ([item.name for item in items if item.ok]).
+    Nothing else (attribute access on objects, imports, lambdas, assignment)
+    compiles. Unknown context fields evaluate to null. Every string or list an
+    evaluation builds counts against EXPRESSION_MAX_ELEMENTS.
+    """
+
+    __slots__ = ("source", "names", "_evaluate", "_spent")
+
+    def __init__(self, source: str):
+        self.source = source
+        try:
+            tree = ast.parse(source.strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"Invalid expression {source!r}: {e.msg}")
+        names: set = set()
+        self._evaluate = self._compile(tree.body, frozenset(), names)
+        self.names = sorted(names)
+
+    def evaluate(self, context: dict) -> Any:
+        self._spent = 0
+        return self._evaluate(context)
+
+    def _spend(self, count: int) -> None:
+        self._spent += count
+        if self._spent > EXPRESSION_MAX_ELEMENTS:
+            raise ValueError(f"Expression built more than {EXPRESSION_MAX_ELEMENTS} string or list elements")
+
+    def _charge(self, value: Any) -> Any:
+        """value, after counting a string or list result against the length limits"""
+        if isinstance(value, (str, list)):
+            _check_length(len(value))
+            self._spend(len(value))
+        return value
+
+    def _compile(self, node: ast.AST, bound: frozenset, names: set) -> Callable[[dict], Any]:
+        def compile_child(child: ast.AST) -> Callable[[dict], Any]:
+            return self._compile(child, bound, names)
+
+        if isinstance(node, ast.Constant):
+            value = node.value
+            if not isinstance(value, (str, int, float, bool, type(None))):
+                raise ValueError(f"Unsupported literal in expression: {value!r}")
+            return lambda scope: value
+
+        if isinstance(node, ast.Name):
+            name = node.id
+            if name not in bound:
+                if name.lower() in EXPRESSION_CONSTANTS:
+                    value = EXPRESSION_CONSTANTS[name.lower()]
+                    return lambda scope: value
+                names.add(name)
+            return lambda scope: scope.get(name)
+
+        if isinstance(node, ast.Attribute):
+            target, attribute = compile_child(node.value), node.attr
+            return lambda scope: _field(target(scope), attribute)
+
+        if isinstance(node, ast.Subscript):
+            target = compile_child(node.value)
+            if isinstance(node.slice, ast.Slice):
+                bounds = [compile_child(part) if part is not None else (lambda scope: None)
+                          for part in (node.slice.lower, node.slice.upper, node.slice.step)]
+                return lambda scope: self._charge(target(scope)[slice(*(part(scope) for part in bounds))])
+            key = compile_child(node.slice)
+            return lambda scope: _field(target(scope), key(scope))
+
+        if isinstance(node, ast.BoolOp):
+            operands = [compile_child(value) for value in node.values]
+            if isinstance(node.op, ast.And):
+                def evaluate_and(scope):
+                    value = True
+                    for operand in operands:
+                        value = operand(scope)
+                        if not value:
+                            return value
+                    return value
+                return evaluate_and
+
+            def evaluate_or(scope):
+                value = False
+                for operand in operands:
+                    value = operand(scope)
+                    if value:
+                        return value
+                return value
+            return evaluate_or
+
+        if isinstance(node, ast.Compare):
+            left = compile_child(node.left)
+            chain = []
+            for op, comparator in zip(node.ops, node.comparators):
+                if type(op) not in COMPARE_OPERATORS:
+                    raise ValueError(f"Unsupported comparison in expression: {type(op).__name__}")
+                chain.append((COMPARE_OPERATORS[type(op)], compile_child(comparator)))
+
+            def evaluate_compare(scope):
+                a = left(scope)
+                for operator, right in chain:
+                    b = right(scope)
+                    if not operator(a, b):
+                        return False
+                    a = b
+                return True
+            return evaluate_compare
+
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in BINARY_OPERATORS:
+                raise ValueError(f"Unsupported operator in expression: {type(node.op).__name__}")
+            operator, left, right = BINARY_OPERATORS[type(node.op)], compile_child(node.left), compile_child(node.right)
+            return lambda scope: self._charge(operator(left(scope), right(scope)))
+
+        if isinstance(node, ast.UnaryOp):
+            if type(node.op) not in UNARY_OPERATORS:
+                raise ValueError(f"Unsupported operator in expression: {type(node.op).__name__}")
+            operator, operand = UNARY_OPERATORS[type(node.op)], compile_child(node.operand)
+            return lambda scope: operator(operand(scope))
+
+        if isinstance(node, ast.IfExp):
+            test, body, orelse = compile_child(node.test), compile_child(node.body), compile_child(node.orelse)
+            return lambda scope: body(scope) if test(scope) else orelse(scope)
+
+        if isinstance(node, (ast.List, ast.Tuple)):
+            items = [compile_child(item) for item in node.elts]
+            return lambda scope: [item(scope) for item in items]
+
+        if isinstance(node, ast.Dict):
+            if any(key is None for key in node.keys):
+                raise ValueError("Unsupported syntax in expression: ** unpacking")
+            pairs = [(compile_child(key), compile_child(value)) for key, value in zip(node.keys, node.values)]
+            return lambda scope: {key(scope): value(scope) for key, value in pairs}
+
+        if isinstance(node, ast.ListComp):
+            if len(node.generators) != 1 or not isinstance(node.generators[0].target, ast.Name) or node.generators[0].is_async:
+                raise ValueError("List comprehensions take exactly one 'for <name> in <list>' clause")
+            generator = node.generators[0]
+            variable = generator.target.id
+            iterable = compile_child(generator.iter)
+            inner = bound | {variable}
+            element = self._compile(node.elt, inner, names)
+            filters = [self._compile(test, inner, names) for test in generator.ifs]
+
+            def evaluate_comprehension(scope):
+                items = iterable(scope)
+                if items is None:
+                    return []
+                if isinstance(items, dict):
+                    items = list(items)
+                results = []
+                local = {}
+                nested = ChainMap(local, scope)
+                for item in items:
+                    local[variable] = item
+                    if all(test(nested) for test in filters):
+                        results.append(element(nested))
+                        _check_length(len(results))
+                        self._spend(1)
+                return results
+            return evaluate_comprehension
+
+        if isinstance(node, ast.Call):
+            if node.keywords:
+                raise ValueError("Keyword arguments are not supported in expressions")
+            args = [compile_child(arg) for arg in node.args]
+            if isinstance(node.func, ast.Name) and node.func.id not in bound:
+                if node.func.id not in EXPRESSION_FUNCTIONS:
+                    raise ValueError(f"Unknown function in expression: {node.func.id}")
+                function = EXPRESSION_FUNCTIONS[node.func.id]
+                return lambda scope: self._charge(function(*(arg(scope) for arg in args)))
+            if isinstance(node.func, ast.Attribute):
+                target, method = compile_child(node.func.value), node.func.attr
+                if not any(method in methods for methods in EXPRESSION_METHODS.values()):
+                    raise ValueError(f"Unknown method in expression: {method}")
+                return lambda scope: self._charge(_call_method(target(scope), method, [arg(scope) for arg in args]))
+            raise ValueError("Only named functions and methods can be called in expressions")
+
+        raise ValueError(f"Unsupported syntax in expression: {type(node).__name__}")
+
+
+expression_cache = CompileCache(Expression, EXPRESSION_CACHE_SIZE)
+
+
+class StepCache:
+    """LRU cache of completed step results keyed by (step definition, inputs read)
+
+    The key covers only the fields that determine a step's result (not id,
+    depends_on or output_key) and the values of the context keys the step
+    reads. Editing a step therefore misses for that step, and its dependents
+    only miss if its output actually changed.
+    """
+
+    IGNORED_FIELDS = ("id", "depends_on", "output_key")
+
+    def __init__(self, max_size: int = STEP_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._results: "OrderedDict[str, str]" = OrderedDict()
+
+    def key(self, step: dict, inputs: dict) -> Optional[str]:
+        """Cache key for running step on inputs, the part of the context it reads (None if they cannot be hashed)"""
+        definition = {field: value for field, value in step.items() if field not in self.IGNORED_FIELDS}
+        try:
+            payload = json.dumps([definition, inputs], sort_keys=True, default=str)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        result = self._results.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        return json.loads(result)
+
+    def put(self, key: str, result: dict):
+        try:
+            self._results[key] = json.dumps(result, default=str)
+        except (TypeError, ValueError):
+            return
+        self._results.move_to_end(key)
+        if len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._results),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+step_cache = StepCache()
+
+
+def json_size(value: Any) -> Optional[int]:
+    """Size in bytes of value serialized as JSON (None if it cannot be)"""
+    try:
+        return len(json.dumps(value, default=str).encode())
+    except (TypeError, ValueError):
+        return None
+
+
+class LatencyHistogram:
+    """Latency histogram with logarithmic buckets (5% wide, from 1µs)
+
+    Memory stays constant no matter how many samples are recorded, and
+    percentiles are accurate to the bucket width.
+    """
+
+    GROWTH = 1.05
+    MINIMUM = 1e-6
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self._buckets: Dict[int, int] = {}
+
+    def record(self, seconds: float):
+        bucket = 0 if seconds <= self.MINIMUM else int(math.log(seconds / self.MINIMUM, self.GROWTH)) + 1
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """Upper bound of the bucket holding the given fraction of samples, in seconds"""
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min(self.MINIMUM * self.GROWTH ** bucket, self.maximum)
+        return self.maximum
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3),
+            "p50_ms": round(self.percentile(0.50) * 1000, 3),
+            "p95_ms": round(self.percentile(0.95) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "max_ms": round(self.maximum * 1000, 3),
+        }
+
+
+class Profiler:
+    """Latency histograms per workflow, per step type, and for queue wait
+
+    Step histograms only count executed steps, not step_cache hits.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.workflows: Dict[str, LatencyHistogram] = {}
+        self.step_types: Dict[str, LatencyHistogram] = {}
+        self.queue_wait = LatencyHistogram()
+
+    def record_step(self, step_type: str, seconds: float, queue_wait: float, cached: bool):
+        self.queue_wait.record(queue_wait)
+        if not cached:
+            self.step_types.setdefault(step_type, LatencyHistogram()).record(seconds)
+
+    def record_workflow(self, workflow_id: str, seconds: float):
+        self.workflows.setdefault(workflow_id, LatencyHistogram()).record(seconds)
+
+    def stats(self, workflow_id: Optional[str] = None) -> dict:
+        workflows = self.workflows if workflow_id is None else {
+            workflow_id: self.workflows.get(workflow_id, LatencyHistogram())
+        }
+        return {
+            "since": self.started,
+            "workflows": {name: histogram.summary() for name, histogram in sorted(workflows.items())},
+            "step_types": {name: histogram.summary() for name, histogram in sorted(self.step_types.items())},
+            "queue_wait": self.queue_wait.summary(),
+        }
+
+
+profiler = Profiler()
+
+
+def folded_profile(frames: List[tuple]) -> List[str]:
+    """Flame-graph input ("root;step;sub-step self_µs" lines) from (stack, seconds) frames
+
+    Frames with the same stack (e.g. one sub-step over many map elements) are
+    summed, and a frame's self time excludes the time of its children.
+    Children that ran concurrently can exceed their parent; self time is then 0.
+    """
+    totals: Dict[str, float] = {}
+    for stack, seconds in frames:
+        totals[stack] = totals.get(stack, 0.0) + seconds
+    children: Dict[str, float] = {}
+    for stack, seconds in totals.items():
+        parent = stack.rpartition(";")[0]
+        if parent in totals:
+            children[parent] = children.get(parent, 0.0) + seconds
+    return [
+        f"{stack} {max(0, round((seconds - children.get(stack, 0.0)) * 1e6))}"
+        for stack, seconds in sorted(totals.items())
+    ]
+
+
+def substitute_variables(prompt: str, variables: dict) -> str:
+    """Substitute variables in prompt template (compiled once, then served from the cache)"""
+    return template_cache.get(prompt).render(variables)
+
+
+# Pre-tokenizer in the style of GPT BPE tokenizers: contractions, words with
+# their leading space, 1-3 digit groups, punctuation runs and whitespace.
+# The alternatives cover every character, so the pieces join back to the text.
+TOKEN_PATTERN = re.compile(
+    r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+"
+)
+
+# Frequent words longer than seven letters that BPE vocabularies hold as one token
+COMMON_LONG_WORDS = (
+    "question questions response responses summarize following information important different "
+    "examples language languages document documents instructions instruction assistant customer "
+    "customers available provided including something anything everything understand understanding "
+    "description descriptions function functions structure required contexts analysis generate "
+    "generated previous original together additional specific although national business children "
+    "continue possible problems research students programs software development management government "
+    "experience processing category categories translate translation sentence sentences paragraph "
+    "paragraphs keywords feedback variable variables template templates workflow workflows position "
+    "identify relevant reference therefore according messages interest security"
+).split()
+
+
+class TokenEstimator:
+    """Offline BPE-style token counter with a cached vocabulary
+
+    Text is split at spaces into chunks (a word with its punctuation, as a
+    BPE pre-tokenizer would keep the leading space with the word). The token
+    count of each chunk comes from a vocabulary dict; a chunk seen for the
+    first time is split with TOKEN_PATTERN and estimated once from the shape
+    of its pieces (short words are one token, longer and all-caps words split
+    into several, camelCase at case changes, digits in groups of three,
+    non-Latin text per character), then added to the vocabulary. Counting
+    text made of known chunks is therefore a str.split plus dict lookups.
+    Counts approximate, not reproduce, a model's tokenizer.
+    """
+
+    def __init__(self, max_vocabulary: int = TOKEN_VOCABULARY_SIZE):
+        self.max_vocabulary = max_vocabulary
+        self._seed = {"": 0, **{piece: 1 for word in COMMON_LONG_WORDS for piece in (word, word.capitalize())}}
+        self._vocabulary: Dict[str, int] = dict(self._seed)
+
+    def count(self, text: str) -> int:
+        chunks = text.split(" ")
+        try:
+            return sum(map(self._vocabulary.__getitem__, chunks))
+        except KeyError:
+            return sum(map(self._lookup, chunks))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Longest prefix of text estimated at no more than max_tokens"""
+        used = 0
+        end = 0
+        for chunk in text.split(" "):
+            tokens = self._lookup(chunk)
+            if used + tokens > max_tokens:
+                # Cut inside the chunk, piece by piece
+                for piece in TOKEN_PATTERN.findall(chunk):
+                    tokens = self._estimate(piece)
+                    if used + tokens > max_tokens:
+                        # A long piece keeps the share of its characters that fits
+                        end += len(piece) * (max_tokens - used) // tokens
+                        break
+                    used += tokens
+                    end += len(piece)
+                break
+            used += tokens
+            end += len(chunk) + 1
+        return text[:end].rstrip(" ")
+
+    def _lookup(self, chunk: str) -> int:
+        tokens = self._vocabulary.get(chunk)
+        if tokens is None:
+            if len(self._vocabulary) >= self.max_vocabulary:
+                self._vocabulary = dict(self._seed)
+            pieces = TOKEN_PATTERN.findall(chunk if chunk[0].isspace() else " " + chunk)
+            tokens = self._vocabulary[chunk] = sum(map(self._estimate, pieces))
+        return tokens
+
+    @staticmethod
+    def _estimate(piece: str) -> int:
+        core = piece[1:] if piece[:1] == " " and len(piece) > 1 else piece
+        if core.isspace():
+            return math.ceil(len(core) / 8)
+        if not core.isascii():
+            wide = sum(1 for char in core if ord(char) >= 0x3000)
+            return max(1, wide + math.ceil((len(core) - wide) * 0.4))
+        if core.isdigit():
+            return 1
+        if not core.isalpha():
+            return math.ceil(len(core) / 2)
+        if core.isupper():
+            return 1 if len(core) <= 3 else math.ceil(len(core) / 3)
+        if not (core.islower() or core[1:].islower()):
+            # camelCase / PascalCase: estimate each part
+            parts = re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+", core)
+            return sum(TokenEstimator._estimate(part) for part in parts) or 1
+        if len(core) <= 7:
+            return 1
+        return 1 + math.ceil((len(core) - 7) / 5)
+
+    def stats(self) -> dict:
+        return {"vocabulary": len(self._vocabulary), "max_vocabulary": self.max_vocabulary}
+
+
+token_estimator = TokenEstimator()
+
+
+def fit_variables(template: CompiledTemplate, variables: dict, max_tokens: int, names: Optional[List[str]] = None) -> tuple:
+    """Truncate variables so the rendered template fits in max_tokens
+
+    Only the named variables (default: every variable the template uses) are
+    shortened, longest first, down to a common token level, so short values
+    survive intact. Returns the new variables and {name: [tokens before,
+    tokens after]} for every truncated variable.
+    """
+    names = [name for name in (names if names is not None else template.variables) if name in variables]
+    fitted = dict(variables)
+    sizes = {name: token_estimator.count(str(variables[name])) for name in names}
+    truncated: Dict[str, list] = {}
+    for _ in range(8):
+        excess = token_estimator.count(template.render(fitted)) - max_tokens
+        if excess <= 0:
+            return fitted, truncated
+        current = {name: token_estimator.count(str(fitted[name])) for name in names}
+        if not any(current.values()):
+            break
+        # Lower a common cap until the variables shed at least the excess
+        level = max(current.values())
+        while level > 0 and sum(max(0, tokens - level) for tokens in current.values()) < excess:
+            level -= max(1, level // 16)
+        level = max(0, level)
+        for name, tokens in current.items():
+            if tokens > level:
+                fitted[name] = token_estimator.truncate(str(fitted[name]), level)
+                truncated[name] = [sizes[name], token_estimator.count(fitted[name])]
+    raise ValueError(f"Prompt does not fit in {max_tokens} tokens even with truncated variables")
+
+
+def read_variable_sets(path: str) -> Iterator[dict]:
+    """Yield variable sets from a JSONL file or a CSV file with a header row, one at a time"""
+    with open(path, newline="", encoding="utf-8") as f:
+        if Path(path).suffix.lower() == ".csv":
+            yield from csv.DictReader(f)
+            return
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            variables = json.loads(line)
+            if not isinstance(variables, dict):
+                raise ValueError(f"{path}:{line_number}: expected a JSON object")
+            yield variables
+
+
+def step_expressions(step: dict) -> List[Expression]:
+    """Compiled when/condition/transform expressions of a step (served from expression_cache)"""
+    sources = []
+    if step.get("when"):
+        sources.append(step["when"])
+    step_type = step.get("type", "prompt")
+    if step_type == "condition" and step.get("condition"):
+        sources.append(step["condition"])
+    elif step_type == "transform":
+        transform = step.get("transform")
+        if isinstance(transform, dict):
+            sources.extend(transform.values())
+        elif transform:
+            sources.append(transform)
+    elif step_type == "map":
+        if step.get("items"):
+            sources.append(step["items"])
+        if step.get("output"):
+            sources.append(step["output"])
+    for source in sources:
+        if not isinstance(source, str):
+            raise ValueError(f"Expressions must be strings, got {type(source).__name__}")
+    return [expression_cache.get(source) for source in sources]
+
+
+def step_reads(step: dict) -> Optional[List[str]]:
+    """Context keys a step reads (None means it may read the whole context)"""
     step_type = step.get("type", "prompt")
-    
     if step_type == "prompt":
-        prompt = step.get("prompt", "")
-        # Substitute variables from context
-        prompt = substitute_variables(prompt, context)
-        return {"type": "prompt", "result": prompt, "status": "completed"}
-    
-    elif step_type == "condition":
-        condition = step.get("condition", "")
-        # Simple condition evaluation (can be enhanced)
-        if condition in context and context[condition]:
-            return {"type": "condition", "result": True, "status": "completed"}
-        return {"type": "condition", "result": False, "status": "completed"}
+        reads = list(template_cache.get(step.get("prompt", "")).variables)
+    elif step_type == "map" or step_type == "transform" and not step.get("transform"):
+        return None
+    else:
+        reads = []
+    for expression in step_expressions(step):
+        reads.extend(expression.names)
+    return list(dict.fromkeys(reads))
+
+
+def step_inputs(step: dict, context: dict) -> dict:
+    """The part of the context a step reads"""
+    reads = step_reads(step)
+    return context if reads is None else {name: context[name] for name in reads if name in context}
+
+
+async def execute_workflow_step(step: dict, context: dict) -> dict:
+    """Execute a single workflow step
+
+    A step whose "when" expression is false is skipped. Condition steps
+    evaluate "condition" to a boolean; transform steps evaluate "transform"
+    (one expression, or an object of named expressions) to their result.
+    """
+    step_type = step.get("type", "prompt")
     
-    elif step_type == "transform":
-        transform_func = step.get("transform", "")
-        # Simple transform (can be enhanced with actual transformation logic)
-        return {"type": "transform", "result": context, "status": "completed"}
+    try:
+        if step.get("when") and not expression_cache.get(step["when"]).evaluate(context):
+            return {"type": step_type, "result": None, "status": "skipped"}
+        
+        if step_type == "prompt":
+            prompt = step.get("prompt", "")
+            # Substitute variables from context
+            prompt = substitute_variables(prompt, context)
+            return {"type": "prompt", "result": prompt, "status": "completed"}
+        
+        elif step_type == "condition":
+            condition = step.get("condition", "")
+            result = bool(condition) and bool(expression_cache.get(condition).evaluate(context))
+            return {"type": "condition", "result": result, "status": "completed"}
+        
+        elif step_type == "transform":
+            transform = step.get("transform", "")
+            if isinstance(transform, dict):
+                result = {key: expression_cache.get(source).evaluate(context) for key, source in transform.items()}
+            elif transform:
+                result = expression_cache.get(transform).evaluate(context)
+            else:
+                # No expression: a snapshot of the context
+                result = dict(context)
+            return {"type": "transform", "result": result, "status": "completed"}
+    except Exception as e:
+        return {"type": step_type, "result": None, "status": "error", "error": str(e)}
     
     return {"type": step_type, "result": None, "status": "error", "error": "Unknown step type"}
 
 
+class WorkflowPlan:
+    """Validated dependency graph of a workflow's steps
+
+    Steps are identified by their "id" (default "step<n>", 1-based) and list
+    the ids they wait for in "depends_on". A workflow in which no step uses
+    depends_on keeps the original sequential semantics: every step depends on
+    the one before it. Unknown ids, cycles and invalid expressions are
+    rejected when the plan is built, i.e. at prompt_create_workflow time,
+    which also leaves the compiled expressions in expression_cache. The
+    sub-workflow of every map step is planned the same way, recursively.
+    """
+
+    def __init__(self, steps: List[dict]):
+        self.steps = steps
+        self.ids = [str(step.get("id", f"step{index + 1}")) for index, step in enumerate(steps)]
+        index_of = {}
+        for index, step_id in enumerate(self.ids):
+            if step_id in index_of:
+                raise ValueError(f"Duplicate step id: {step_id}")
+            index_of[step_id] = index
+        sequential = not any("depends_on" in step for step in steps)
+        self.depends_on: List[List[int]] = []
+        for index, step in enumerate(steps):
+            if sequential:
+                self.depends_on.append([index - 1] if index else [])
+                continue
+            names = step.get("depends_on", [])
+            if isinstance(names, str):
+                names = [names]
+            unknown = [name for name in names if name not in index_of]
+            if unknown:
+                raise ValueError(f"Step {self.ids[index]} depends on unknown step(s): {', '.join(unknown)}")
+            self.depends_on.append(sorted({index_of[name] for name in names}))
+        self.dependents: List[List[int]] = [[] for _ in steps]
+        for index, parents in enumerate(self.depends_on):
+            for parent in parents:
+                self.dependents[parent].append(index)
+        self.order = self._topological_order()
+        self.sub_plans: Dict[int, "WorkflowPlan"] = {}
+        for index, step in enumerate(steps):
+            try:
+                step_expressions(step)
+                if step.get("type") == "map":
+                    self.sub_plans[index] = self._map_plan(step)
+            except ValueError as e:
+                raise ValueError(f"Step {self.ids[index]}: {e}")
+
+    @staticmethod
+    def _map_plan(step: dict) -> "WorkflowPlan":
+        if not step.get("items"):
+            raise ValueError("map steps need an items expression")
+        if not isinstance(step.get("steps"), list) or not step["steps"]:
+            raise ValueError("map steps need a non-empty steps list")
+        if not str(step.get("as", "item")).isidentifier():
+            raise ValueError(f"Invalid map variable name: {step.get('as')}")
+        if step.get("on_error", "fail_fast") not in MAP_ERROR_MODES:
+            raise ValueError(f"on_error must be one of: {', '.join(MAP_ERROR_MODES)}")
+        return WorkflowPlan(step["steps"])
+
+    def _topological_order(self) -> List[int]:
+        waiting = [len(parents) for parents in self.depends_on]
+        ready = [index for index, count in enumerate(waiting) if count == 0]
+        order = []
+        while ready:
+            index = ready.pop()
+            order.append(index)
+            for child in self.dependents[index]:
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    ready.append(child)
+        if len(order) < len(self.steps):
+            cycle = [self.ids[index] for index, count in enumerate(waiting) if count > 0]
+            raise ValueError(f"Workflow has a dependency cycle among steps: {', '.join(cycle)}")
+        return order
+
+
+async def run_workflow(
+    plan: WorkflowPlan,
+    context: dict,
+    concurrency: int = WORKFLOW_CONCURRENCY,
+    use_cache: bool = True,
+    frames: Optional[List[tuple]] = None,
+    stack: str = "workflow",
+    sizes: bool = PROFILE_SIZES,
+) -> List[dict]:
+    """Run steps as soon as their dependencies finish, at most concurrency at a time
+
+    A step sees the context outputs of every step it (transitively) depends
+    on. Completed results are memoized in step_cache; each result reports
+    whether it was served from there. Results are returned in step
+    definition order, each with a "timing" of monotonic queue wait (ready
+    until started) and duration, plus input/output sizes if sizes is set
+    (serializing them is not free). Durations also go to the profiler and,
+    as (stack, seconds), to frames if given.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    waiting = [len(parents) for parents in plan.depends_on]
+    results: List[Optional[dict]] = [None] * len(plan.steps)
+
+    async def run(index: int, ready: float) -> tuple:
+        async with semaphore:
+            started = time.perf_counter()
+            step = plan.steps[index]
+            step_stack = f"{stack};{plan.ids[index]}"
+            timing = {"queue_ms": round((started - ready) * 1000, 3)}
+            inputs = step_inputs(step, context) if use_cache or sizes else None
+            if sizes:
+                timing["input_bytes"] = json_size(inputs)
+            key = step_cache.key(step, inputs) if use_cache else None
+            step_result = step_cache.get(key) if key is not None else None
+            cached = step_result is not None
+            if cached and index in plan.sub_plans:
+                await replay_map_step(step, step_result)
+            if not cached:
+                if index in plan.sub_plans:
+                    step_result = await run_map_step(step, plan.sub_plans[index], context, use_cache, frames, step_stack, sizes)
+                else:
+                    step_result = await execute_workflow_step(step, context)
+                if key is not None and step_result.get("status") == "completed":
+                    step_cache.put(key, step_result)
+            seconds = time.perf_counter() - started
+            timing["duration_ms"] = round(seconds * 1000, 3)
+            if sizes:
+                timing["output_bytes"] = json_size(step_result.get("result"))
+            profiler.record_step(step.get("type", "prompt"), seconds, started - ready, cached)
+            if frames is not None:
+                frames.append((step_stack, seconds))
+            return index, step_result, cached, timing
+
+    pending = {asyncio.ensure_future(run(index, time.perf_counter())) for index, count in enumerate(waiting) if count == 0}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index, step_result, cached, timing = task.result()
+                step = plan.steps[index]
+                results[index] = {"id": plan.ids[index], **step_result, "cached": cached, "timing": timing}
+                # Update context with step result
+                if "output_key" in step and step_result.get("status") != "skipped":
+                    context[step["output_key"]] = step_result.get("result")
+                for child in plan.dependents[index]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        pending.add(asyncio.ensure_future(run(child, time.perf_counter())))
+    finally:
+        for task in pending:
+            task.cancel()
+    return results
+
+
+# How a map step handles a failed element: stop at once, or record it and go on
+MAP_ERROR_MODES = ("fail_fast", "collect")
+
+
+class MapItemFailed(Exception):
+    """An item of a fail-fast map step failed"""
+
+
+def progress_reporter() -> Optional[Callable[..., Awaitable[None]]]:
+    """Coroutine sending progress notifications for the current tool call (None if the client did not ask)"""
+    try:
+        context = server.request_context
+    except LookupError:
+        return None
+    token = getattr(context.meta, "progressToken", None) if context.meta else None
+    if token is None:
+        return None
+
+    async def report(progress: float, total: float, message: str):
+        await context.session.send_progress_notification(token, progress, total, message=message)
+    return report
+
+
+async def run_map_step(
+    step: dict,
+    plan: WorkflowPlan,
+    context: dict,
+    use_cache: bool = True,
+    frames: Optional[List[tuple]] = None,
+    stack: str = "map",
+    sizes: bool = PROFILE_SIZES,
+) -> dict:
+    """Run a map step's sub-workflow once per element of its items list
+
+    Each element runs in its own copy of the context with the element bound
+    to the step's "as" name (default "item") and its position to "index".
+    At most "concurrency" elements run at once. An element's output is its
+    "output" expression evaluated in that context, or else the result of the
+    sub-workflow's last step. Outputs are collected in element order. Each
+    finished element is reported as a progress notification (when the client
+    sent a progress token) and appended to "output_path" (JSONL) if set.
+    With on_error "fail_fast" the first failed element cancels the rest;
+    with "collect" failures are listed in "errors" and their outputs are null.
+    """
+    items = expression_cache.get(step["items"]).evaluate(context)
+    if not isinstance(items, list):
+        return {"type": "map", "result": None, "status": "error", "error": f"items must evaluate to a list, got {type(items).__name__}"}
+    name = step.get("as", "item")
+    output = expression_cache.get(step["output"]) if step.get("output") else None
+    fail_fast = step.get("on_error", "fail_fast") == "fail_fast"
+    outputs: List[Any] = [None] * len(items)
+    errors: List[dict] = []
+    pending = iter(range(len(items)))
+    report = progress_reporter()
+    stream = open(step["output_path"], "w", encoding="utf-8") if step.get("output_path") else None
+    finished = 0
+
+    async def run_item(index: int) -> dict:
+        item_context = {**context, name: items[index], "index": index}
+        results = await run_workflow(plan, item_context, use_cache=use_cache, frames=frames, stack=stack, sizes=sizes)
+        failed = next((step_result for step_result in results if step_result["status"] == "error"), None)
+        if failed is not None:
+            return {"index": index, "status": "error", "error": f"step {failed['id']}: {failed.get('error')}"}
+        try:
+            value = output.evaluate(item_context) if output is not None else results[-1]["result"]
+        except Exception as e:
+            return {"index": index, "status": "error", "error": f"output: {e}"}
+        return {"index": index, "status": "completed", "output": value}
+
+    async def worker():
+        nonlocal finished
+        for index in pending:
+            item_result = await run_item(index)
+            finished += 1
+            if item_result["status"] == "completed":
+                outputs[index] = item_result["output"]
+            else:
+                errors.append({"index": index, "error": item_result["error"]})
+            if stream is not None:
+                stream.write(json.dumps(item_result, default=str) + "\n")
+            if report is not None:
+                await report(finished, len(items), json.dumps(item_result, default=str))
+            if fail_fast and item_result["status"] == "error":
+                raise MapItemFailed(f"item {index}: {item_result['error']}")
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(max(1, int(step.get("concurrency", WORKFLOW_CONCURRENCY))), len(items)))]
+    try:
+        if workers:
+            done, _ = await asyncio.wait(workers, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+    except MapItemFailed as e:
+        return {"type": "map", "result": outputs, "status": "error", "error": str(e), "items": len(items), "errors": errors}
+    finally:
+        for task in workers:
+            task.cancel()
+        if stream is not None:
+            stream.close()
+    errors.sort(key=lambda error: error["index"])
+    result = {"type": "map", "result": outputs, "status": "partial" if errors else "completed", "items": len(items)}
+    if errors:
+        result["errors"] = errors
+    return result
+
+
+async def replay_map_step(step: dict, step_result: dict):
+    """Side effects of a map step served from step_cache
+
+    Rewrites output_path from the cached outputs and sends one completion
+    progress notification, so a cached map step looks like an executed one
+    to the client. Only completed (error-free) map results are cached.
+    """
+    outputs = step_result.get("result") or []
+    if step.get("output_path"):
+        with open(step["output_path"], "w", encoding="utf-8") as stream:
+            for index, output in enumerate(outputs):
+                stream.write(json.dumps({"index": index, "status": "completed", "output": output}, default=str) + "\n")
+    report = progress_reporter()
+    if report is not None:
+        await report(len(outputs), len(outputs), json.dumps({"status": "completed", "items": len(outputs), "cached": True}))
+
+
 @server.call_tool()
 async def call_tool(name: str, arguments: dict) -> list[TextContent]:
     """Handle tool calls"""
@@ -122,8 +1440,13 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
             prompt = arguments["prompt"]
             variables = arguments.get("variables", {})
             
+            template = template_cache.get(prompt)
+            truncated = None
+            if arguments.get("max_tokens") is not None:
+                variables, truncated = fit_variables(template, variables, int(arguments["max_tokens"]), arguments.get("truncate"))
+            
             # Substitute variables
-            result_prompt = substitute_variables(prompt, variables)
+            result_prompt = template.render(variables)
             
             output_format = arguments.get("output_format", "text")
             result = {
@@ -131,6 +1454,10 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
                 "variables": variables,
                 "output_format": output_format,
             }
+            if arguments.get("count_tokens", False) or truncated is not None:
+                result["tokens"] = token_estimator.count(result_prompt)
+            if truncated:
+                result["truncated"] = truncated
             
             execution_history.append({
                 "type": "prompt_execute",
@@ -139,56 +1466,147 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
             
             return [TextContent(type="text", text=json.dumps(result, indent=2))]
         
+        elif name == "prompt_execute_batch":
+            if ("variables_list" in arguments) == ("path" in arguments):
+                raise ValueError("Provide exactly one of variables_list or path")
+            template = template_cache.get(arguments["prompt"])
+            if "path" in arguments:
+                variable_sets = read_variable_sets(arguments["path"])
+            else:
+                variable_sets = iter(arguments["variables_list"])
+            started = time.perf_counter()
+            count = 0
+            result: Dict[str, Any] = {"variables": template.variables}
+            if "output_path" in arguments:
+                with open(arguments["output_path"], "w", encoding="utf-8") as out:
+                    for count, variables in enumerate(variable_sets, 1):
+                        out.write(json.dumps({"index": count - 1, "prompt": template.render(variables)}) + "\n")
+                result["output_path"] = arguments["output_path"]
+            else:
+                prompts = [template.render(variables) for variables in variable_sets]
+                count = len(prompts)
+                result["prompts"] = prompts
+            seconds = time.perf_counter() - started
+            result["count"] = count
+            result["renders_per_second"] = round(count / seconds, 1) if seconds > 0 else 0.0
+            
+            execution_history.append({
+                "type": "prompt_execute_batch",
+                "result": {"prompt": arguments["prompt"], "count": count},
+            })
+            
+            return [TextContent(type="text", text=json.dumps(result, indent=2))]
+        
+        elif name == "prompt_count_tokens":
+            if ("text" in arguments) == ("texts" in arguments):
+                raise ValueError("Provide exactly one of text or texts")
+            if "text" in arguments:
+                return [TextContent(type="text", text=json.dumps({"tokens": token_estimator.count(arguments["text"])}, indent=2))]
+            started = time.perf_counter()
+            counts = list(map(token_estimator.count, arguments["texts"]))
+            seconds = time.perf_counter() - started
+            result = {
+                "counts": counts,
+                "total": sum(counts),
+                "max": max(counts, default=0),
+                "texts_per_second": round(len(counts) / seconds, 1) if seconds > 0 else 0.0,
+            }
+            if arguments.get("max_tokens") is not None:
+                result["over_limit"] = [index for index, tokens in enumerate(counts) if tokens > arguments["max_tokens"]]
+            return [TextContent(type="text", text=json.dumps(result, indent=2))]
+        
         elif name == "prompt_create_workflow":
             workflow_id = arguments["workflow_id"]
-            workflows[workflow_id] = {
+            plan = WorkflowPlan(arguments["steps"])
+            workflow_store.put({
                 "id": workflow_id,
                 "steps": arguments["steps"],
                 "description": arguments.get("description", ""),
-            }
+            }, plan)
             return [TextContent(type="text", text=json.dumps({"status": "created", "workflow_id": workflow_id}, indent=2))]
         
         elif name == "prompt_execute_workflow":
             workflow_id = arguments["workflow_id"]
-            if workflow_id not in workflows:
-                raise ValueError(f"Workflow not found: {workflow_id}")
+            plan = workflow_store.plan(workflow_id)
             
-            workflow = workflows[workflow_id]
             context = arguments.get("input_data", {})
-            results = []
-            
-            for step in workflow["steps"]:
-                step_result = await execute_workflow_step(step, context)
-                results.append(step_result)
-                # Update context with step result
-                if "output_key" in step:
-                    context[step["output_key"]] = step_result.get("result")
+            frames: List[tuple] = []
+            started = time.perf_counter()
+            results = await run_workflow(
+                plan,
+                context,
+                int(arguments.get("concurrency", WORKFLOW_CONCURRENCY)),
+                arguments.get("use_cache", True),
+                frames,
+                workflow_id,
+                PROFILE_SIZES or arguments.get("profile", False),
+            )
+            seconds = time.perf_counter() - started
+            profiler.record_workflow(workflow_id, seconds)
             
-            execution_history.append({
+            entry = {
                 "type": "workflow_execute",
                 "workflow_id": workflow_id,
                 "results": results,
-            })
+                "duration_ms": round(seconds * 1000, 3),
+            }
+            slow = SLOW_WORKFLOW_MS is not None and seconds * 1000 >= SLOW_WORKFLOW_MS
+            if slow or arguments.get("profile", False):
+                frames.append((workflow_id, seconds))
+                entry["profile"] = folded_profile(frames)
+            execution_history.append(entry)
             
-            return [TextContent(type="text", text=json.dumps({"workflow_id": workflow_id, "results": results}, indent=2))]
+            response = {
+                "workflow_id": workflow_id,
+                "results": results,
+                "cache_hits": sum(1 for step_result in results if step_result["cached"]),
+                "duration_ms": entry["duration_ms"],
+            }
+            if "profile" in entry:
+                response["profile"] = entry["profile"]
+            return [TextContent(type="text", text=json.dumps(response, indent=2))]
+        
+        elif name == "prompt_get_history":
+            cursor = arguments.get("cursor")
+            try:
+                before = int(cursor) if cursor not in (None, "") else None
+            except ValueError:
+                raise ValueError(f"Invalid cursor: {cursor}")
+            entries, next_cursor = execution_history.page(
+                workflow_id=arguments.get("workflow_id"),
+                entry_type=arguments.get("type"),
+                since=arguments.get("since"),
+                until=arguments.get("until"),
+                before=before,
+                limit=min(max(1, int(arguments.get("limit", 50))), 1000),
+            )
+            page = {"entries": entries, "next_cursor": None if next_cursor is None else str(next_cursor), "total": len(execution_history)}
+            return [TextContent(type="text", text=json.dumps(page, indent=2))]
+        
+        elif name == "prompt_get_stats":
+            stats = profiler.stats(arguments.get("workflow_id"))
+            stats["caches"] = {
+                "templates": template_cache.stats(),
+                "expressions": expression_cache.stats(),
+                "steps": step_cache.stats(),
+                "tokens": token_estimator.stats(),
+            }
+            if arguments.get("reset", False):
+                profiler.reset()
+            return [TextContent(type="text", text=json.dumps(stats, indent=2))]
         
         elif name == "prompt_list_workflows":
-            workflow_list = [
-                {
-                    "id": wf["id"],
-                    "description": wf.get("description", ""),
-                    "steps_count": len(wf["steps"]),
-                }
-                for wf in workflows.values()
-            ]
+            limit = arguments.get("limit")
+            workflow_list = workflow_store.summaries(
+                query=arguments.get("query"),
+                after=arguments.get("after"),
+                limit=None if limit is None else max(0, int(limit)),
+            )
             return [TextContent(type="text", text=json.dumps(workflow_list, indent=2))]
         
         elif name == "prompt_get_workflow":
             workflow_id = arguments["workflow_id"]
-            if workflow_id not in workflows:
-                raise ValueError(f"Workflow not found: {workflow_id}")
-            
-            return [TextContent(type="text", text=json.dumps(workflows[workflow_id], indent=2))]
+            return [TextContent(type="text", text=json.dumps(workflow_store.get(workflow_id), indent=2))]
         
         else:
             raise ValueError(f"Unknown tool: {name}")
@@ -199,8 +1617,12 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
 
 async def main():
     """Main entry point"""
-    async with stdio_server() as (read_stream, write_stream):
-        await server.run(read_stream, write_stream, server.create_initialization_options())
+    try:
+        async with stdio_server() as (read_stream, write_stream):
+            await server.run(read_stream, write_stream, server.create_initialization_options())
+    finally:
+        if database is not None:
+            database.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Recall/latency benchmark for the Vector Search MCP server
+
+Generates clustered synthetic corpora, drives the server's tool handlers
+(store, search, list, delete) in-process and reports throughput, latency
+percentiles, memory and recall@k against brute force as JSON.
+
+    python benchmark.py --sizes 10000,100000 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent))
+import server  # noqa: E402
+
+
+def rss_bytes() -> int:
+    """Current resident set size (peak RSS where /proc is unavailable)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def clustered_vectors(rng: np.random.Generator, centers: np.ndarray, count: int, spread: float) -> np.ndarray:
+    """Gaussian blobs around randomly chosen cluster centers"""
+    labels = rng.integers(0, len(centers), count)
+    noise = rng.standard_normal((count, centers.shape[1]), dtype=np.float32)
+    return centers[labels] + spread * noise
+
+
+def brute_force(corpus: np.ndarray, queries: np.ndarray, k: int, metric: str) -> list:
+    """Exact top-k row indices for each query"""
+    if metric == "cosine":
+        corpus, queries = server.normalize_rows(corpus), server.normalize_rows(queries)
+    if metric == "euclidean":
+        scores = 2 * queries @ corpus.T - np.einsum("ij,ij->i", corpus, corpus)
+    else:
+        scores = queries @ corpus.T
+    return [set(server.top_k_indices(row, k).tolist()) for row in scores]
+
+
+def percentiles(samples: list) -> dict:
+    latencies = np.array(samples) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(latencies, 50)), 4),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 4),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 4),
+        "mean_ms": round(float(latencies.mean()), 4),
+    }
+
+
+async def call(name: str, arguments: dict):
+    """Invoke a tool handler and decode its JSON response"""
+    text = (await server.call_tool(name, arguments))[0].text
+    if text.startswith("Error:"):
+        raise RuntimeError(f"{name} failed: {text}")
+    return json.loads(text)
+
+
+async def run_size(size: int, args: argparse.Namespace) -> dict:
+    """Benchmark one corpus size in a fresh collection"""
+    rng = np.random.default_rng(args.seed)
+    centers = rng.standard_normal((args.clusters, args.dim), dtype=np.float32)
+    corpus = clustered_vectors(rng, centers, size, args.spread)
+    queries = clustered_vectors(rng, centers, args.queries, args.spread)
+    collection = f"bench_{size}"
+    if collection in server.collections:
+        server.drop_collection(collection)
+    await call("vector_create_collection", {
+        "name": collection,
+        "metric": args.metric,
+        "index": args.index,
+        "precision": args.precision,
+    })
+    result = {"size": size}
+    rss_before = rss_bytes()
+
+    print(f"[{size}] storing", file=sys.stderr)
+    started = time.perf_counter()
+    for offset in range(0, size, args.batch_size):
+        documents = [
+            {"id": f"doc-{i}", "text": f"synthetic document {i}", "embedding": corpus[i].tolist(), "metadata": {"n": i}}
+            for i in range(offset, min(offset + args.batch_size, size))
+        ]
+        await call("vector_store_batch", {"documents": documents, "collection": collection})
+    seconds = time.perf_counter() - started
+    result["store"] = {"seconds": round(seconds, 3), "docs_per_second": round(size / seconds, 1)}
+
+    stats = await call("vector_collection_stats", {"name": collection})
+    result["memory"] = {
+        "rss_delta_bytes": rss_bytes() - rss_before,
+        "matrix_bytes": stats["matrix_bytes"],
+        "codes_bytes": stats["codes_bytes"],
+        "index_bytes": stats["index_bytes"],
+        "bytes_per_document": round((rss_bytes() - rss_before) / size, 1),
+    }
+
+    print(f"[{size}] searching", file=sys.stderr)
+    expected = brute_force(corpus, queries, args.k, args.metric)
+    latencies = []
+    recall = 0.0
+    for query, truth in zip(queries, expected):
+        started = time.perf_counter()
+        matches = await call("vector_search", {
+            "query": "benchmark",
+            "embedding": query.tolist(),
+            "top_k": args.k,
+            "threshold": -1e30,
+            "collection": collection,
+        })
+        latencies.append(time.perf_counter() - started)
+        recall += len(truth & {int(match["id"][4:]) for match in matches}) / args.k
+    result["search"] = {
+        "queries": len(queries),
+        "qps": round(len(queries) / sum(latencies), 1),
+        "recall_at_k": round(recall / len(queries), 4),
+        "k": args.k,
+        **percentiles(latencies),
+    }
+
+    started = time.perf_counter()
+    for offset in range(0, len(queries), args.search_batch):
+        block = queries[offset:offset + args.search_batch]
+        await call("vector_search_batch", {
+            "queries": ["benchmark"] * len(block),
+            "embeddings": block.tolist(),
+            "top_k": args.k,
+            "threshold": -1e30,
+            "collection": collection,
+        })
+    seconds = time.perf_counter() - started
+    result["search_batch"] = {"batch_size": args.search_batch, "qps": round(len(queries) / seconds, 1)}
+
+    print(f"[{size}] listing", file=sys.stderr)
+    latencies = []
+    cursor = None
+    for _ in range(args.list_pages):
+        started = time.perf_counter()
+        page = await call("vector_list", {"limit": args.page_size, "cursor": cursor, "fields": ["id"], "collection": collection})
+        latencies.append(time.perf_counter() - started)
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    result["list"] = {"pages": len(latencies), "page_size": args.page_size, **percentiles(latencies)}
+
+    print(f"[{size}] deleting", file=sys.stderr)
+    deletions = max(1, int(size * args.delete_fraction))
+    latencies = []
+    for i in rng.choice(size, deletions, replace=False):
+        started = time.perf_counter()
+        await call("vector_delete", {"id": f"doc-{i}", "collection": collection})
+        latencies.append(time.perf_counter() - started)
+    result["delete"] = {"deletes": deletions, "qps": round(deletions / sum(latencies), 1), **percentiles(latencies)}
+
+    server.drop_collection(collection)
+    return result
+
+
+async def main():
+    """Run the benchmark for every requested corpus size"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000", help="Comma-separated corpus sizes (e.g. 10000,100000,1000000)")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=100, help="Gaussian clusters in the synthetic corpus")
+    parser.add_argument("--spread", type=float, default=0.5, help="Standard deviation around each cluster center")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--metric", default="cosine", choices=list(server.VECTOR_METRICS))
+    parser.add_argument("--index", default=server.VECTOR_INDEX, choices=["flat", "ivf"])
+    parser.add_argument("--precision", default=server.VECTOR_PRECISION, choices=list(server.VECTOR_PRECISIONS))
+    parser.add_argument("--batch-size", type=int, default=10000, help="Documents per vector_store_batch call")
+    parser.add_argument("--search-batch", type=int, default=50, help="Queries per vector_search_batch call")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--list-pages", type=int, default=100)
+    parser.add_argument("--delete-fraction", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = {
+        "benchmark": "vector-search-mcp",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "machine": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "search_workers": server.SEARCH_WORKERS,
+        },
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": [],
+    }
+    for size in (int(size) for size in args.sizes.split(",")):
+        report["results"].append(await run_size(size, args))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,9 +5,20 @@ Provides tools for vector search, embeddings, and memory operations.
 """
 
 import asyncio
+import base64
+import hashlib
 import json
+import multiprocessing
 import os
-from typing import Any, Optional, List, Dict
+import re
+import shutil
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Iterator, Optional, List, Dict
 import numpy as np
 
 from mcp.server import Server
@@ -17,36 +28,2166 @@ from mcp.types import Tool, TextContent
 # Initialize MCP server
 server = Server("vector-search-mcp")
 
-# Simple in-memory vector store (can be replaced with proper vector DB)
-vector_store: Dict[str, dict] = {}
-embeddings_cache: Dict[str, List[float]] = {}
-
-
-def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
-    """Calculate cosine similarity between two vectors"""
-    vec1 = np.array(vec1)
-    vec2 = np.array(vec2)
-    dot_product = np.dot(vec1, vec2)
-    norm1 = np.linalg.norm(vec1)
-    norm2 = np.linalg.norm(vec2)
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
-    return float(dot_product / (norm1 * norm2))
-
-
-async def generate_embedding(text: str) -> List[float]:
-    """Generate embedding for text (simplified - should use actual embedding model)"""
-    # In production, this would call OpenAI, Gemini, or local embedding model
-    # For now, using a simple hash-based approach as placeholder
-    import hashlib
-    hash_obj = hashlib.md5(text.encode())
-    hash_hex = hash_obj.hexdigest()
-    # Convert to 384-dim vector (common embedding size)
-    embedding = [float(int(hash_hex[i:i+2], 16) / 255.0) for i in range(0, min(384, len(hash_hex)), 2)]
-    # Pad if needed
-    while len(embedding) < 384:
-        embedding.append(0.0)
-    return embedding[:384]
+# Rows compacted away once tombstones exceed this count and half the matrix
+COMPACT_MIN_TOMBSTONES = 1024
+
+# Approximate nearest-neighbour index: "flat" (exact scan) or "ivf"
+VECTOR_INDEX = os.getenv("VECTOR_INDEX", "flat")
+IVF_NLIST = int(os.getenv("VECTOR_IVF_NLIST", "0"))  # 0 = sqrt(corpus size)
+IVF_NPROBE = int(os.getenv("VECTOR_IVF_NPROBE", "8"))
+IVF_MIN_TRAIN_SIZE = int(os.getenv("VECTOR_IVF_MIN_TRAIN_SIZE", "4096"))
+KMEANS_ITERATIONS = 10
+
+# Lexical (BM25) scoring and hybrid rank fusion
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+
+# Storage precision of the in-memory rows: float32, float16, int8 or pq
+VECTOR_PRECISION = os.getenv("VECTOR_PRECISION", "float32")
+VECTOR_PRECISIONS = ("float32", "float16", "int8", "pq")
+VECTOR_RERANK = int(os.getenv("VECTOR_RERANK", "4"))  # re-score rerank * top_k candidates
+PQ_SUBSPACES = int(os.getenv("VECTOR_PQ_SUBSPACES", "0"))  # 0 = dim / 8
+PQ_MIN_TRAIN_SIZE = int(os.getenv("VECTOR_PQ_MIN_TRAIN_SIZE", "4096"))
+
+# Near-duplicate detection: random-hyperplane LSH, verified by cosine similarity
+VECTOR_DEDUP = os.getenv("VECTOR_DEDUP", "off")  # off, flag or reject on insert
+DEDUP_THRESHOLD = float(os.getenv("VECTOR_DEDUP_THRESHOLD", "0.95"))
+LSH_BANDS = int(os.getenv("VECTOR_LSH_BANDS", "16"))
+LSH_BITS = int(os.getenv("VECTOR_LSH_BITS", "16"))  # at most 32
+
+# Streaming ingestion: sliding-window chunker feeding batched embedding
+INGEST_CHUNK_SIZE = int(os.getenv("VECTOR_INGEST_CHUNK_SIZE", "1000"))  # characters
+INGEST_CHUNK_OVERLAP = int(os.getenv("VECTOR_INGEST_CHUNK_OVERLAP", "200"))
+INGEST_BATCH_SIZE = int(os.getenv("VECTOR_INGEST_BATCH_SIZE", "64"))
+INGEST_QUEUE_DEPTH = 4  # chunk batches buffered between the chunker and the embedder
+INGEST_READ_BYTES = 256 * 1024
+
+# Named collections; each has its own metric, index and storage precision
+VECTOR_METRICS = ("cosine", "dot", "euclidean")
+DEFAULT_COLLECTION = "default"
+COLLECTION_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Sharded search: worker processes score row ranges of a shared matrix (0 = in-process)
+SEARCH_WORKERS = int(os.getenv("VECTOR_SEARCH_WORKERS", "0"))
+SHARD_MIN_ROWS = int(os.getenv("VECTOR_SHARD_MIN_ROWS", "65536"))  # smaller stores are scored in-process
+
+# Upper bound on the query x document score block computed at once (in floats)
+SEARCH_SCORE_BUDGET = 16 * 1024 * 1024
+
+# Durable storage: memory-mapped vectors plus a write-ahead log (empty = in-memory only)
+VECTOR_DATA_DIR = os.getenv("VECTOR_DATA_DIR", "")
+VECTOR_CHECKPOINT_BYTES = int(os.getenv("VECTOR_CHECKPOINT_BYTES", str(64 * 1024 * 1024)))
+
+# Embedding backend: "hashing" (local, deterministic) or "openai"
+VECTOR_EMBEDDER = os.getenv("VECTOR_EMBEDDER", "hashing")
+EMBEDDING_DIM = int(os.getenv("VECTOR_EMBEDDING_DIM", "384"))
+HASHING_MAX_NGRAM = int(os.getenv("VECTOR_HASHING_MAX_NGRAM", "2"))
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Embedding cache: in-memory LRU byte budget and optional on-disk tier
+EMBEDDING_CACHE_BYTES = int(os.getenv("VECTOR_EMBEDDING_CACHE_BYTES", str(64 * 1024 * 1024)))
+EMBEDDING_CACHE_DIR = os.getenv("VECTOR_EMBEDDING_CACHE_DIR", "")
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize each row (zero rows are returned unchanged)"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens"""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first"""
+    if k <= 0 or len(scores) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class IVFIndex:
+    """Inverted-file ANN index: rows are bucketed by their nearest k-means centroid"""
+
+    def __init__(self, nlist: int = IVF_NLIST, nprobe: int = IVF_NPROBE, min_train_size: int = IVF_MIN_TRAIN_SIZE):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train_size = min_train_size
+        self.centroids: Optional[np.ndarray] = None
+        self.build_seconds = 0.0
+        self.trained_size = 0
+        self._lists: List[np.ndarray] = []
+        self._list_sizes = np.zeros(0, dtype=np.int64)
+        self._assignment = np.zeros(0, dtype=np.int32)
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    @property
+    def memory_bytes(self) -> int:
+        if not self.trained:
+            return 0
+        return int(self.centroids.nbytes + self._assignment.nbytes + sum(lst.nbytes for lst in self._lists))
+
+    def train(self, vectors: Callable[[np.ndarray], np.ndarray], rows: np.ndarray):
+        """Cluster rows with spherical k-means and rebuild the inverted lists"""
+        start = time.perf_counter()
+        rng = np.random.default_rng(0)
+        nlist = min(self.nlist or max(1, int(np.sqrt(len(rows)))), len(rows))
+        sample = rows if len(rows) <= nlist * 64 else rng.choice(rows, nlist * 64, replace=False)
+        data = vectors(np.sort(sample))
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(data @ centroids.T, axis=1)
+            order = np.argsort(labels, kind="stable")
+            counts = np.bincount(labels, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            present = np.flatnonzero(counts)
+            starts = np.concatenate(([0], np.cumsum(counts[present])[:-1]))
+            sums[present] = np.add.reduceat(data[order], starts, axis=0)
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = sums / norms
+        self.centroids = centroids.astype(np.float32)
+        self._lists = [np.zeros(16, dtype=np.int64) for _ in range(nlist)]
+        self._list_sizes = np.zeros(nlist, dtype=np.int64)
+        self._assignment = np.full(int(rows.max()) + 1 if len(rows) else 0, -1, dtype=np.int32)
+        self.add_many(vectors, rows)
+        self.trained_size = len(rows)
+        self.build_seconds += time.perf_counter() - start
+
+    def add_many(self, vectors: Callable[[np.ndarray], np.ndarray], rows: np.ndarray, batch_size: int = 8192):
+        """Assign rows to their nearest centroid's list"""
+        if len(rows) == 0:
+            return
+        if rows.max() >= len(self._assignment):
+            assignment = np.full(max(int(rows.max()) + 1, len(self._assignment) * 2), -1, dtype=np.int32)
+            assignment[:len(self._assignment)] = self._assignment
+            self._assignment = assignment
+        for offset in range(0, len(rows), batch_size):
+            batch = rows[offset:offset + batch_size]
+            labels = np.argmax(vectors(batch) @ self.centroids.T, axis=1)
+            self._assignment[batch] = labels
+            for label in np.unique(labels):
+                self._append(int(label), batch[labels == label])
+
+    def _append(self, label: int, rows: np.ndarray):
+        size = self._list_sizes[label]
+        lst = self._lists[label]
+        if size + len(rows) > len(lst):
+            grown = np.zeros(max(len(lst) * 2, size + len(rows)), dtype=np.int64)
+            grown[:size] = lst[:size]
+            self._lists[label] = lst = grown
+        lst[size:size + len(rows)] = rows
+        self._list_sizes[label] = size + len(rows)
+
+    def remove(self, row: int):
+        """Remove a row from its list (swap with the last entry)"""
+        if not self.trained or row >= len(self._assignment) or self._assignment[row] < 0:
+            return
+        label = self._assignment[row]
+        self._assignment[row] = -1
+        size = self._list_sizes[label]
+        lst = self._lists[label]
+        position = np.flatnonzero(lst[:size] == row)
+        if len(position):
+            lst[position[0]] = lst[size - 1]
+            self._list_sizes[label] = size - 1
+
+    def remap(self, new_row_of: np.ndarray):
+        """Renumber rows after the store has been compacted"""
+        if not self.trained:
+            return
+        for label, lst in enumerate(self._lists):
+            size = self._list_sizes[label]
+            self._lists[label] = new_row_of[lst[:size]].copy()
+        assignment = np.full(len(new_row_of), -1, dtype=np.int32)
+        live = new_row_of >= 0
+        assignment[new_row_of[live]] = self._assignment[:len(new_row_of)][live]
+        self._assignment = assignment
+
+    def candidates(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """Rows stored in the nprobe lists closest to the query"""
+        nprobe = min(int(nprobe or self.nprobe), len(self._lists))
+        probe = top_k_indices(self.centroids @ query, nprobe)
+        return np.concatenate([self._lists[label][:self._list_sizes[label]] for label in probe])
+
+    def stats(self) -> dict:
+        sizes = self._list_sizes
+        return {
+            "type": "ivf",
+            "trained": self.trained,
+            "nlist": len(self._lists),
+            "nprobe": self.nprobe,
+            "trained_size": self.trained_size,
+            "list_size_min": int(sizes.min()) if len(sizes) else 0,
+            "list_size_max": int(sizes.max()) if len(sizes) else 0,
+            "list_size_mean": float(sizes.mean()) if len(sizes) else 0.0,
+            "build_seconds": round(self.build_seconds, 4),
+            "memory_bytes": self.memory_bytes,
+        }
+
+
+class LSHIndex:
+    """Random-hyperplane LSH over unit vectors, for near-duplicate lookup
+
+    Every vector gets bands * bits sign bits. Two vectors at angle a share a
+    band's code with probability (1 - a / pi) ** bits, so near-duplicates
+    collide in at least one band almost surely while unrelated vectors rarely
+    do. Each band keeps its codes sorted (with their rows) for binary search;
+    recently added rows are scanned linearly until the next merge. Deleted rows
+    are left in place and filtered out by the caller.
+    """
+
+    def __init__(self, dim: int, bands: int = LSH_BANDS, bits: int = LSH_BITS, seed: int = 0, planes: Optional[np.ndarray] = None):
+        self.dim = dim
+        self.bands = bands
+        self.bits = bits
+        if planes is None:
+            planes = np.random.default_rng(seed).standard_normal((dim, bands * bits)).astype(np.float32)
+        self.planes = planes
+        self.codes = np.zeros((0, bands), dtype=np.uint32)
+        self._weights = 1 << np.arange(bits, dtype=np.int64)
+        self._size = 0
+        self._merged = 0
+        self._sorted_codes = np.zeros((bands, 0), dtype=np.uint32)
+        self._sorted_rows = np.zeros((bands, 0), dtype=np.int64)
+
+    @property
+    def memory_bytes(self) -> int:
+        return int(self.planes.nbytes + self.codes.nbytes + self._sorted_codes.nbytes + self._sorted_rows.nbytes)
+
+    def hash(self, vectors: np.ndarray) -> np.ndarray:
+        """Per-band codes of the given vectors"""
+        signs = (vectors @ self.planes > 0).reshape(len(vectors), self.bands, self.bits)
+        return (signs @ self._weights).astype(np.uint32)
+
+    def add(self, start: int, vectors: np.ndarray):
+        """Hash vectors into rows start, start + 1, ..."""
+        self.add_codes(start, self.hash(vectors))
+
+    def add_codes(self, start: int, codes: np.ndarray):
+        """Store already hashed codes as rows start, start + 1, ..."""
+        end = start + len(codes)
+        if end > len(self.codes):
+            grown = np.zeros((max(end, 2 * len(self.codes)), self.bands), dtype=np.uint32)
+            grown[:self._size] = self.codes[:self._size]
+            self.codes = grown
+        self.codes[start:end] = codes
+        self._size = max(self._size, end)
+
+    def compact(self, live: np.ndarray):
+        """Keep only the live rows, renumbered in order"""
+        self.codes = self.codes[live]
+        self._size = len(live)
+        self._merged = 0
+        self._sorted_codes = np.zeros((self.bands, 0), dtype=np.uint32)
+        self._sorted_rows = np.zeros((self.bands, 0), dtype=np.int64)
+
+    def _merge(self):
+        order = np.argsort(self.codes[:self._size], axis=0, kind="stable")
+        self._sorted_rows = np.ascontiguousarray(order.T)
+        self._sorted_codes = np.ascontiguousarray(np.take_along_axis(self.codes[:self._size], order, axis=0).T)
+        self._merged = self._size
+
+    def candidates(self, codes: np.ndarray) -> Iterator[np.ndarray]:
+        """For each row of codes, the sorted rows sharing at least one band code"""
+        if self._size - self._merged > max(1024, self._merged // 8):
+            self._merge()
+        pending = self.codes[self._merged:self._size]
+        lows = np.empty((self.bands, len(codes)), dtype=np.int64)
+        highs = np.empty((self.bands, len(codes)), dtype=np.int64)
+        for band in range(self.bands):
+            lows[band] = np.searchsorted(self._sorted_codes[band], codes[:, band], side="left")
+            highs[band] = np.searchsorted(self._sorted_codes[band], codes[:, band], side="right")
+        for i, code in enumerate(codes):
+            found = [self._sorted_rows[band, lows[band, i]:highs[band, i]] for band in range(self.bands) if highs[band, i] > lows[band, i]]
+            if len(pending):
+                found.append(self._merged + np.flatnonzero((pending == code).any(axis=1)))
+            yield np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+
+def metadata_key(value: Any) -> Optional[tuple]:
+    """Hashable posting key for a metadata value (ints and floats compare equal)"""
+    if isinstance(value, bool):
+        return ("b", value)
+    if isinstance(value, (int, float)):
+        return ("n", float(value))
+    if isinstance(value, str):
+        return ("s", value)
+    return None
+
+
+class MetadataIndex:
+    """Inverted index over top-level metadata fields
+
+    Scalar values (and each element of list values) get a posting set of rows.
+    Numeric values are also kept in a per-field column sorted by value, so range
+    filters are two binary searches. New numeric entries are buffered and merged
+    into the sorted column once the buffer is large enough; deleted rows are
+    dropped from the columns lazily, at merge time.
+    """
+
+    RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[tuple, set]] = {}
+        self._columns: Dict[str, tuple] = {}
+        self._pending: Dict[str, List[tuple]] = {}
+
+    @staticmethod
+    def _keys(metadata: dict):
+        for field, value in metadata.items():
+            for item in value if isinstance(value, list) else [value]:
+                key = metadata_key(item)
+                if key is not None:
+                    yield field, key
+
+    def add(self, row: int, metadata: dict):
+        for field, key in self._keys(metadata):
+            self._postings.setdefault(field, {}).setdefault(key, set()).add(row)
+            if key[0] == "n":
+                self._pending.setdefault(field, []).append((key[1], row))
+
+    def remove(self, row: int, metadata: dict):
+        for field, key in self._keys(metadata):
+            postings = self._postings.get(field, {})
+            rows = postings.get(key)
+            if rows is not None:
+                rows.discard(row)
+                if not rows:
+                    del postings[key]
+
+    def _column(self, field: str, alive: np.ndarray) -> tuple:
+        """Sorted (values, rows) for a numeric field plus its unmerged entries"""
+        values, rows = self._columns.get(field, (np.zeros(0), np.zeros(0, dtype=np.int64)))
+        pending = self._pending.get(field, [])
+        if len(pending) > max(1024, len(values) // 8):
+            values = np.concatenate((values, np.array([value for value, _ in pending])))
+            rows = np.concatenate((rows, np.array([row for _, row in pending], dtype=np.int64)))
+            keep = alive[rows]
+            order = np.argsort(values[keep], kind="stable")
+            values, rows = values[keep][order], rows[keep][order]
+            self._columns[field] = (values, rows)
+            self._pending[field] = pending = []
+        return values, rows, pending
+
+    def _equal(self, field: str, values: list) -> np.ndarray:
+        postings = self._postings.get(field, {})
+        matched = set()
+        for value in values:
+            matched |= postings.get(metadata_key(value), set())
+        return np.fromiter(matched, dtype=np.int64, count=len(matched))
+
+    def _range(self, field: str, bounds: dict, alive: np.ndarray) -> np.ndarray:
+        values, rows, pending = self._column(field, alive)
+        low, high = 0, len(values)
+        if "$gt" in bounds:
+            low = max(low, np.searchsorted(values, bounds["$gt"], side="right"))
+        if "$gte" in bounds:
+            low = max(low, np.searchsorted(values, bounds["$gte"], side="left"))
+        if "$lt" in bounds:
+            high = min(high, np.searchsorted(values, bounds["$lt"], side="left"))
+        if "$lte" in bounds:
+            high = min(high, np.searchsorted(values, bounds["$lte"], side="right"))
+        matched = [rows[low:high]] if low < high else []
+        if pending:
+            extra = [row for value, row in pending if self._in_bounds(value, bounds)]
+            matched.append(np.array(extra, dtype=np.int64))
+        return np.concatenate(matched) if matched else np.zeros(0, dtype=np.int64)
+
+    @staticmethod
+    def _in_bounds(value: float, bounds: dict) -> bool:
+        return (
+            ("$gt" not in bounds or value > bounds["$gt"])
+            and ("$gte" not in bounds or value >= bounds["$gte"])
+            and ("$lt" not in bounds or value < bounds["$lt"])
+            and ("$lte" not in bounds or value <= bounds["$lte"])
+        )
+
+    def match(self, metadata_filter: dict, alive: np.ndarray) -> np.ndarray:
+        """Sorted live rows matching every condition of the filter"""
+        candidates = []
+        for field, condition in metadata_filter.items():
+            if not (isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition)):
+                condition = {"$eq": condition}
+            bounds = {}
+            for op, operand in condition.items():
+                if op == "$eq":
+                    candidates.append(self._equal(field, [operand]))
+                elif op == "$in":
+                    candidates.append(self._equal(field, list(operand)))
+                elif op in self.RANGE_OPERATORS:
+                    bounds[op] = float(operand)
+                else:
+                    raise ValueError(f"Unsupported filter operator: {op}")
+            if bounds:
+                candidates.append(self._range(field, bounds, alive))
+        if not candidates:
+            return np.flatnonzero(alive)
+        candidates.sort(key=len)
+        rows = np.unique(candidates[0])
+        for other in candidates[1:]:
+            if len(rows) == 0:
+                break
+            rows = np.intersect1d(rows, other)
+        return rows[alive[rows]]
+
+
+class VectorCodec:
+    """Compressed row storage; subclasses keep row-aligned arrays in self.arrays"""
+
+    name = "float32"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.arrays: Dict[str, np.ndarray] = {}
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return int(sum(array[:1].nbytes for array in self.arrays.values()))
+
+    @property
+    def memory_bytes(self) -> int:
+        return int(sum(array.nbytes for array in self.arrays.values()))
+
+    @property
+    def capacity(self) -> int:
+        return min((len(array) for array in self.arrays.values()), default=0)
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """Arrays that fully describe the encoded rows, for persisting them"""
+        return dict(self.arrays)
+
+    def restore(self, state: Dict[str, np.ndarray], rows: int):
+        """Adopt (possibly memory-mapped) arrays from state() that hold rows encoded rows"""
+        self.arrays = dict(state)
+
+    def resize(self, capacity: int):
+        for name, array in self.arrays.items():
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            rows = min(len(array), capacity)
+            grown[:rows] = array[:rows]
+            self.arrays[name] = grown
+
+    def compact(self, live: np.ndarray, capacity: int):
+        for name, array in self.arrays.items():
+            compacted = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            compacted[:len(live)] = array[live]
+            self.arrays[name] = compacted
+
+    def set(self, start: int, vectors: np.ndarray):
+        raise NotImplementedError
+
+    def decode(self, rows) -> np.ndarray:
+        raise NotImplementedError
+
+    def score_rows(self, queries: np.ndarray, rows) -> np.ndarray:
+        return queries @ self.decode(rows).T
+
+    def score(self, queries: np.ndarray, stop: int, chunk_size: int = 65536) -> np.ndarray:
+        """Scores for rows [0, stop), decoding one chunk of rows at a time"""
+        scores = np.empty((len(queries), stop), dtype=np.float32)
+        for offset in range(0, stop, chunk_size):
+            end = min(offset + chunk_size, stop)
+            scores[:, offset:end] = self.score_rows(queries, slice(offset, end))
+        return scores
+
+
+class Float16Codec(VectorCodec):
+    """Half-precision rows (2 bytes per dimension)"""
+
+    name = "float16"
+
+    def __init__(self, dim: int):
+        super().__init__(dim)
+        self.arrays["codes"] = np.zeros((0, dim), dtype=np.float16)
+
+    def set(self, start: int, vectors: np.ndarray):
+        self.arrays["codes"][start:start + len(vectors)] = vectors
+
+    def decode(self, rows) -> np.ndarray:
+        return self.arrays["codes"][rows].astype(np.float32)
+
+
+class Int8Codec(VectorCodec):
+    """Scalar int8 quantization with one float32 scale per vector
+
+    The last float_columns columns (the euclidean norm column) are kept at
+    float32, so their magnitude does not crush the scale of the others.
+    """
+
+    name = "int8"
+
+    def __init__(self, dim: int, float_columns: int = 0):
+        super().__init__(dim)
+        self.quantized = dim - float_columns
+        self.arrays["codes"] = np.zeros((0, self.quantized), dtype=np.int8)
+        self.arrays["scales"] = np.zeros(0, dtype=np.float32)
+        if float_columns:
+            self.arrays["floats"] = np.zeros((0, float_columns), dtype=np.float32)
+
+    def set(self, start: int, vectors: np.ndarray):
+        quantized = vectors[:, :self.quantized]
+        scales = np.abs(quantized).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        self.arrays["codes"][start:start + len(vectors)] = np.rint(quantized / scales[:, None])
+        self.arrays["scales"][start:start + len(vectors)] = scales
+        if "floats" in self.arrays:
+            self.arrays["floats"][start:start + len(vectors)] = vectors[:, self.quantized:]
+
+    def decode(self, rows) -> np.ndarray:
+        decoded = self.arrays["codes"][rows].astype(np.float32) * self.arrays["scales"][rows][:, None]
+        if "floats" in self.arrays:
+            decoded = np.hstack([decoded, self.arrays["floats"][rows]])
+        return decoded
+
+    def score_rows(self, queries: np.ndarray, rows) -> np.ndarray:
+        scores = (queries[:, :self.quantized] @ self.arrays["codes"][rows].astype(np.float32).T) * self.arrays["scales"][rows]
+        if "floats" in self.arrays:
+            scores += queries[:, self.quantized:] @ self.arrays["floats"][rows].T
+        return scores
+
+
+class PQCodec(VectorCodec):
+    """Product quantization: one byte per subspace, scored with asymmetric distance tables
+
+    Rows are kept at float32 until PQ_MIN_TRAIN_SIZE of them have arrived, then
+    the per-subspace codebooks are trained with k-means and every row is encoded.
+    """
+
+    name = "pq"
+    CENTROIDS = 256
+
+    def __init__(self, dim: int, subspaces: int = PQ_SUBSPACES, min_train_size: int = PQ_MIN_TRAIN_SIZE):
+        super().__init__(dim)
+        subspaces = min(subspaces or max(1, dim // 8), dim)
+        while dim % subspaces:
+            subspaces -= 1
+        self.subspaces = subspaces
+        self.min_train_size = min_train_size
+        self.codebooks: Optional[np.ndarray] = None
+        self.build_seconds = 0.0
+        self._filled = 0
+        self.arrays["raw"] = np.zeros((0, dim), dtype=np.float32)
+
+    @property
+    def trained(self) -> bool:
+        return self.codebooks is not None
+
+    @property
+    def memory_bytes(self) -> int:
+        return super().memory_bytes + (int(self.codebooks.nbytes) if self.trained else 0)
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        return vectors.reshape(len(vectors), self.subspaces, self.dim // self.subspaces)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        parts = self._split(vectors)
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        half_norms = 0.5 * (self.codebooks ** 2).sum(axis=2)
+        for j in range(self.subspaces):
+            codes[:, j] = np.argmax(parts[:, j] @ self.codebooks[j].T - half_norms[j], axis=1)
+        return codes
+
+    def train(self):
+        """Learn per-subspace codebooks from the buffered rows and encode them"""
+        start = time.perf_counter()
+        rng = np.random.default_rng(0)
+        raw = self.arrays["raw"][:self._filled]
+        sample = raw[rng.choice(len(raw), min(len(raw), self.CENTROIDS * 64), replace=False)]
+        parts = self._split(sample)
+        centroids = min(self.CENTROIDS, len(sample))
+        codebooks = np.zeros((self.subspaces, self.CENTROIDS, self.dim // self.subspaces), dtype=np.float32)
+        for j in range(self.subspaces):
+            data = parts[:, j]
+            book = data[rng.choice(len(data), centroids, replace=False)]
+            for _ in range(KMEANS_ITERATIONS):
+                labels = np.argmax(data @ book.T - 0.5 * (book ** 2).sum(axis=1), axis=1)
+                counts = np.bincount(labels, minlength=centroids)
+                sums = np.stack([np.bincount(labels, weights=data[:, d], minlength=centroids) for d in range(data.shape[1])], axis=1)
+                filled = counts > 0
+                book[filled] = sums[filled] / counts[filled, None]
+            codebooks[j, :centroids] = book
+        self.codebooks = codebooks
+        codes = np.zeros((len(self.arrays["raw"]), self.subspaces), dtype=np.uint8)
+        for offset in range(0, self._filled, 65536):
+            chunk = raw[offset:offset + 65536]
+            codes[offset:offset + len(chunk)] = self._encode(chunk)
+        self.arrays = {"codes": codes}
+        self.build_seconds = time.perf_counter() - start
+
+    def set(self, start: int, vectors: np.ndarray):
+        if self.trained:
+            self.arrays["codes"][start:start + len(vectors)] = self._encode(vectors)
+            return
+        self.arrays["raw"][start:start + len(vectors)] = vectors
+        self._filled = max(self._filled, start + len(vectors))
+        if self._filled >= self.min_train_size:
+            self.train()
+
+    def compact(self, live: np.ndarray, capacity: int):
+        super().compact(live, capacity)
+        if not self.trained:
+            self._filled = len(live)
+
+    def state(self) -> Dict[str, np.ndarray]:
+        state = super().state()
+        if self.trained:
+            state["codebooks"] = self.codebooks
+        return state
+
+    def restore(self, state: Dict[str, np.ndarray], rows: int):
+        state = dict(state)
+        self.codebooks = state.pop("codebooks", None)
+        if self.codebooks is not None:
+            self.subspaces = len(self.codebooks)
+        else:
+            self._filled = rows
+        super().restore(state, rows)
+
+    def decode(self, rows) -> np.ndarray:
+        if not self.trained:
+            return self.arrays["raw"][rows].copy()
+        codes = self.arrays["codes"][rows]
+        return self.codebooks[np.arange(self.subspaces), codes].reshape(len(codes), self.dim)
+
+    def score_rows(self, queries: np.ndarray, rows) -> np.ndarray:
+        if not self.trained:
+            return queries @ self.arrays["raw"][rows].T
+        codes = self.arrays["codes"][rows]
+        tables = np.einsum("qjd,jcd->qjc", self._split(queries), self.codebooks)
+        positions = np.arange(self.subspaces)
+        return np.stack([table[positions, codes].sum(axis=1) for table in tables])
+
+
+def make_codec(precision: str, dim: int, float_columns: int = 0) -> Optional[VectorCodec]:
+    """Codec for the configured storage precision (None means plain float32 rows)
+
+    float_columns trailing columns are stored unquantized by the int8 codec.
+    """
+    if precision == "float32":
+        return None
+    if precision == "int8":
+        return Int8Codec(dim, float_columns)
+    codecs = {"float16": Float16Codec, "pq": PQCodec}
+    if precision not in codecs:
+        raise ValueError(f"Unknown vector precision: {precision}")
+    return codecs[precision](dim)
+
+
+class BM25Index:
+    """Incremental BM25 inverted index over document text
+
+    Posting lists hold (row, term frequency) in increasing row order, in
+    arrays grown geometrically so that adds never copy them whole. Deleted
+    rows stay in the postings and are masked out at query time until the store
+    is compacted and the index rebuilt. Queries are evaluated term-at-a-time in
+    decreasing IDF order; once the remaining terms cannot lift an unseen
+    document into the top k (max-score), long low-IDF posting lists are no
+    longer scanned but probed by binary search for the known candidates only.
+    """
+
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.doc_count = 0
+        self.total_length = 0
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._postings: Dict[str, list] = {}  # term -> [rows, tfs, length]
+        self._df: Dict[str, int] = {}
+        self._scratch = np.zeros(0, dtype=np.float32)
+        self._seen = np.zeros(0, dtype=bool)
+
+    def add(self, row: int, text: str):
+        tokens = tokenize(text)
+        if row >= len(self._lengths):
+            lengths = np.zeros(max(row + 1, len(self._lengths) * 2, 1024), dtype=np.float32)
+            lengths[:len(self._lengths)] = self._lengths
+            self._lengths = lengths
+        self._lengths[row] = len(tokens)
+        self.doc_count += 1
+        self.total_length += len(tokens)
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for term, tf in counts.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = [np.zeros(4, dtype=np.int64), np.zeros(4, dtype=np.float32), 0]
+            rows, tfs, length = posting
+            if length == len(rows):
+                posting[0] = rows = np.concatenate([rows, np.zeros(length, dtype=np.int64)])
+                posting[1] = tfs = np.concatenate([tfs, np.zeros(length, dtype=np.float32)])
+            rows[length] = row
+            tfs[length] = tf
+            posting[2] = length + 1
+            self._df[term] = self._df.get(term, 0) + 1
+
+    def remove(self, row: int, text: str):
+        tokens = tokenize(text)
+        self.doc_count -= 1
+        self.total_length -= len(tokens)
+        for term in set(tokens):
+            self._df[term] -= 1
+
+    def _posting(self, term: str) -> tuple:
+        rows, tfs, length = self._postings[term]
+        return rows[:length], tfs[:length]
+
+    def _term_scores(self, idf: float, rows: np.ndarray, tfs: np.ndarray, avgdl: float) -> np.ndarray:
+        norm = self.k1 * (1 - self.b + self.b * self._lengths[rows] / avgdl)
+        return idf * tfs * (self.k1 + 1) / (tfs + norm)
+
+    def search(self, query: str, k: int, size: int, mask: np.ndarray) -> tuple:
+        """Top k (rows, scores) among rows where mask is True"""
+        terms = [term for term in dict.fromkeys(tokenize(query)) if self._df.get(term, 0) > 0]
+        if not terms or self.doc_count == 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        avgdl = max(self.total_length / self.doc_count, 1e-9)
+        idfs = {
+            term: float(np.log(1 + (self.doc_count - self._df[term] + 0.5) / (self._df[term] + 0.5)))
+            for term in terms
+        }
+        terms.sort(key=lambda term: -idfs[term])
+        remaining = np.cumsum([idfs[term] * (self.k1 + 1) for term in reversed(terms)])[::-1]
+        # Scores accumulate in zeroed scratch arrays, and only rows of the
+        # posting lists are touched (and reset afterwards), never all size rows
+        if len(self._scratch) < len(self._lengths):
+            self._scratch = np.zeros(len(self._lengths), dtype=np.float32)
+            self._seen = np.zeros(len(self._lengths), dtype=bool)
+        scores, seen = self._scratch, self._seen
+        touched: List[np.ndarray] = []
+        candidates = None
+        try:
+            for i, term in enumerate(terms):
+                rows, tfs = self._posting(term)
+                if candidates is None and i > 0 and len(rows) > 4 * k:
+                    # Untouched documents can score at most remaining[i]; once that
+                    # cannot beat the current kth score, only score known candidates
+                    known = np.concatenate(touched)
+                    if len(known) >= k:
+                        kth = np.partition(scores[known], len(known) - k)[len(known) - k]
+                        if kth > 0 and remaining[i] <= kth:
+                            candidates = known
+                if candidates is not None and len(candidates) * 4 < len(rows):
+                    positions = np.minimum(np.searchsorted(rows, candidates), len(rows) - 1)
+                    hit = rows[positions] == candidates
+                    rows, tfs = candidates[hit], tfs[positions[hit]]
+                else:
+                    keep = mask[rows]
+                    rows, tfs = rows[keep], tfs[keep]
+                    new_rows = rows[~seen[rows]]
+                    seen[new_rows] = True
+                    touched.append(new_rows)
+                scores[rows] += self._term_scores(idfs[term], rows, tfs, avgdl)
+            known = np.concatenate(touched) if candidates is None else candidates
+            known_scores = scores[known]
+        finally:
+            for rows in touched:
+                scores[rows] = 0.0
+                seen[rows] = False
+        best = top_k_indices(known_scores, k)
+        return known[best], known_scores[best]
+
+
+_attached: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+
+def _attach(handle: tuple) -> np.ndarray:
+    """Worker side: map a shared array described by (kind, name, shape, dtype), caching the mapping"""
+    entry = _attached.get(handle)
+    if entry is not None:
+        _attached.move_to_end(handle)
+        return entry[1]
+    kind, name, shape, dtype = handle
+    if kind == "shm":
+        segment: Optional[shared_memory.SharedMemory] = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+    else:
+        segment = None
+        array = np.memmap(name, dtype=dtype, mode="r", shape=shape)
+    _attached[handle] = (segment, array)
+    while len(_attached) > 16:
+        old_segment, _ = _attached.popitem(last=False)[1]
+        if old_segment is not None:
+            try:
+                old_segment.close()
+            except BufferError:
+                pass
+    return array
+
+
+def _score_shard(task: tuple) -> tuple:
+    """Worker side: top k (rows, scores) of queries against rows lo:hi of the shared matrix"""
+    matrix_handle, alive_handle, lo, hi, queries, k = task
+    scores = queries @ _attach(matrix_handle)[lo:hi].T
+    if alive_handle is not None:
+        scores[:, ~_attach(alive_handle)[lo:hi]] = -np.inf
+    if k < hi - lo:
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        best = np.broadcast_to(np.arange(hi - lo), scores.shape)
+    return best + lo, np.take_along_axis(scores, best, axis=1)
+
+
+class ShardPool:
+    """Worker processes that score row ranges of matrices shared with the server
+
+    Sharded stores allocate their matrix and liveness mask in
+    multiprocessing.shared_memory (persistent stores share their memory-mapped
+    vector file), so every worker maps the same pages instead of holding a
+    copy. A query block is scattered to one contiguous row range per worker
+    and the per-shard top k lists are merged by the caller. The pool is forked
+    once at startup and serves every collection.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # Workers must share the server's resource tracker, or each would start
+        # its own and unlink the segments it attached to when it exits
+        resource_tracker.ensure_running()
+        self._pool = multiprocessing.get_context("fork").Pool(workers)
+
+    def search(self, matrix: tuple, alive: Optional[tuple], size: int, queries: np.ndarray, k: int) -> tuple:
+        """(rows, scores), each of shape (queries, shards * k), of the per-shard top k"""
+        bounds = np.linspace(0, size, self.workers + 1).astype(np.int64)
+        tasks = [
+            (matrix, alive, int(lo), int(hi), queries, k)
+            for lo, hi in zip(bounds[:-1], bounds[1:])
+            if hi > lo
+        ]
+        parts = self._pool.map(_score_shard, tasks)
+        return np.concatenate([rows for rows, _ in parts], axis=1), np.concatenate([scores for _, scores in parts], axis=1)
+
+    def close(self):
+        self._pool.terminate()
+
+
+class VectorStore:
+    """Vector store backed by one growable float32 matrix
+
+    Rows are L2-normalized for the cosine metric and stored as given for dot.
+    For euclidean, rows x are stored as [x, |x|^2] and queries q as [2q, -1],
+    so the inner product 2q.x - |x|^2 = |q|^2 - |q - x|^2 ranks rows by
+    distance and all metrics share the same matrix-product search path.
+
+    With a reduced precision the matrix is replaced by the codec's compressed
+    rows (the persistent store keeps full-precision rows on disk for re-ranking).
+    """
+
+    def __init__(
+        self,
+        initial_capacity: int = 1024,
+        index: Optional[IVFIndex] = None,
+        precision: str = VECTOR_PRECISION,
+        metric: str = "cosine",
+        shards: Optional[ShardPool] = None,
+    ):
+        if metric not in VECTOR_METRICS:
+            raise ValueError(f"Unknown metric: {metric} (expected one of {', '.join(VECTOR_METRICS)})")
+        self.dim: Optional[int] = None
+        self.docs: Dict[str, dict] = {}
+        self.index = index
+        self.precision = precision
+        self.metric = metric
+        self.shards = shards
+        self.codec: Optional[VectorCodec] = None
+        self.metadata_index = MetadataIndex()
+        self.lexical_index = BM25Index()
+        self.lsh: Optional[LSHIndex] = None  # built on first near-duplicate lookup
+        self._initial_capacity = initial_capacity
+        self._matrix: Optional[np.ndarray] = None
+        self._alive = np.zeros(0, dtype=bool)
+        self._ids: List[Optional[str]] = []
+        self._rows: Dict[str, int] = {}
+        self._seqs = np.zeros(0, dtype=np.int64)  # insertion sequence number per row, increasing
+        self._next_seq = 0
+        self._size = 0
+        self._tombstones = 0
+        self._storage_ready = False
+        self._segments: Dict[str, shared_memory.SharedMemory] = {}
+        self._retired: List[shared_memory.SharedMemory] = []
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    @property
+    def width(self) -> int:
+        """Width of stored rows: the dimension, plus one for the euclidean norm column"""
+        return self.dim + 1 if self.metric == "euclidean" else self.dim
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.docs
+
+    def _new_array(self, role: str, shape: tuple, dtype) -> np.ndarray:
+        """Zeroed storage array, in shared memory when searches are sharded
+
+        The segment previously backing the same role is unlinked right away and
+        closed once nothing references its buffer any more.
+        """
+        self._release_retired()
+        if self.shards is None or 0 in shape:
+            return np.zeros(shape, dtype=dtype)
+        array_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        segment = shared_memory.SharedMemory(create=True, size=array_bytes)
+        array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+        array[:] = 0
+        old = self._segments.get(role)
+        self._segments[role] = segment
+        if old is not None:
+            old.unlink()
+            self._retired.append(old)
+        return array
+
+    def _release_retired(self):
+        retired, self._retired = self._retired, []
+        for segment in retired:
+            try:
+                segment.close()
+            except BufferError:
+                self._retired.append(segment)
+
+    def _array_handle(self, role: str) -> tuple:
+        """Description of a storage array that worker processes can map"""
+        array = self._matrix if role == "matrix" else self._alive
+        return ("shm", self._segments[role].name, array.shape, array.dtype.str)
+
+    def _as_vectors(self, embeddings, queries: bool = False) -> np.ndarray:
+        """Convert embeddings (or queries) to float32 rows in the store's metric space"""
+        try:
+            vectors = np.asarray(embeddings, dtype=np.float32)
+        except ValueError:
+            raise ValueError("All embeddings must have the same dimension")
+        if vectors.ndim != 2:
+            raise ValueError("All embeddings must have the same dimension")
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match store dimension {self.dim}")
+        if self.metric == "cosine":
+            return normalize_rows(vectors)
+        if self.metric == "euclidean":
+            if queries:
+                return np.hstack([2 * vectors, np.full((len(vectors), 1), -1.0, dtype=np.float32)])
+            return np.hstack([vectors, np.einsum("ij,ij->i", vectors, vectors)[:, None]])
+        return vectors
+
+    def _init_storage(self):
+        """Set up vector storage once the dimension is known"""
+        self.codec = make_codec(self.precision, self.width, self.width - self.dim)
+        if self.codec is None:
+            self._matrix = self._new_array("matrix", (0, self.width), np.float32)
+
+    def _ensure_capacity(self, rows: int):
+        """Grow storage geometrically so appends are amortized O(dim)"""
+        capacity = len(self._alive)
+        if rows <= capacity:
+            return
+        new_capacity = max(rows, capacity * 2, self._initial_capacity)
+        self._resize_matrix(new_capacity)
+        if self.codec is not None:
+            self.codec.resize(new_capacity)
+        alive = self._new_array("alive", (new_capacity,), bool)
+        alive[:self._size] = self._alive[:self._size]
+        self._alive = alive
+        seqs = np.zeros(new_capacity, dtype=np.int64)
+        seqs[:self._size] = self._seqs[:self._size]
+        self._seqs = seqs
+
+    def _resize_matrix(self, capacity: int):
+        if self._matrix is None:
+            return
+        matrix = self._new_array("matrix", (capacity, self.width), np.float32)
+        matrix[:self._size] = self._matrix[:self._size]
+        self._matrix = matrix
+
+    def vectors(self, rows) -> np.ndarray:
+        """Float32 rows: full precision when kept, otherwise decoded from the codec"""
+        if self._matrix is not None:
+            return np.asarray(self._matrix[rows], dtype=np.float32)
+        return self.codec.decode(rows)
+
+    def add(self, doc_id: str, text: str, embedding: List[float], metadata: Optional[dict] = None):
+        """Insert or replace a document"""
+        self.add_many([(doc_id, text, embedding, metadata)])
+
+    def add_many(self, items: List[tuple]):
+        """Insert or replace (doc_id, text, embedding, metadata) documents in one block write"""
+        if not items:
+            return
+        vectors = self._as_vectors([embedding for _, _, embedding, _ in items])
+        if not self._storage_ready:
+            if self.dim is None:
+                self.dim = vectors.shape[1] - (1 if self.metric == "euclidean" else 0)
+            self._init_storage()
+            self._storage_ready = True
+        self._ensure_capacity(self._size + len(items))
+        start = self._size
+        if self._matrix is not None:
+            self._matrix[start:start + len(items)] = vectors
+        if self.codec is not None:
+            self.codec.set(start, vectors)
+        self._alive[start:start + len(items)] = True
+        self._seqs[start:start + len(items)] = np.arange(self._next_seq, self._next_seq + len(items))
+        self._next_seq += len(items)
+        for row, (doc_id, text, _, metadata) in enumerate(items, start):
+            if doc_id in self._rows:
+                self._tombstone(doc_id)
+            self._ids.append(doc_id)
+            self._rows[doc_id] = row
+            self.docs[doc_id] = {"id": doc_id, "text": text, "metadata": metadata or {}}
+            self.metadata_index.add(row, metadata or {})
+            self.lexical_index.add(row, text)
+        self._size += len(items)
+        if self.lsh is not None:
+            self.lsh.add(start, normalize_rows(vectors[:, :self.dim]))
+        if self.index is not None:
+            self._index_rows(start + np.flatnonzero(self._alive[start:self._size]))
+
+    def _live_rows(self) -> np.ndarray:
+        return np.flatnonzero(self._alive[:self._size])
+
+    def _index_rows(self, rows: np.ndarray):
+        """Feed new rows to the ANN index, (re)training it as the corpus grows"""
+        if not self.index.trained:
+            if len(self.docs) >= self.index.min_train_size:
+                self.index.train(self.vectors, self._live_rows())
+        elif len(self.docs) > 4 * self.index.trained_size:
+            self.index.train(self.vectors, self._live_rows())
+        else:
+            self.index.add_many(self.vectors, rows)
+
+    def _tombstone(self, doc_id: str):
+        row = self._rows.pop(doc_id)
+        self._alive[row] = False
+        self._ids[row] = None
+        self._tombstones += 1
+        self.metadata_index.remove(row, self.docs[doc_id]["metadata"])
+        self.lexical_index.remove(row, self.docs[doc_id]["text"])
+        if self.index is not None:
+            self.index.remove(row)
+
+    def delete(self, doc_id: str) -> bool:
+        """Delete a document, returning False if it does not exist"""
+        if doc_id not in self._rows:
+            return False
+        self._tombstone(doc_id)
+        del self.docs[doc_id]
+        if self._tombstones >= COMPACT_MIN_TOMBSTONES and self._tombstones * 2 > self._size:
+            self.compact()
+        return True
+
+    def compact(self):
+        """Drop tombstoned rows and renumber the remaining ones"""
+        live = self._live_rows()
+        capacity = max(len(live), self._initial_capacity)
+        if self.index is not None:
+            new_row_of = np.full(self._size, -1, dtype=np.int64)
+            new_row_of[live] = np.arange(len(live))
+            self.index.remap(new_row_of)
+        if self._matrix is not None:
+            self._matrix = self._compact_matrix(live, capacity)
+        if self.codec is not None:
+            self.codec.compact(live, capacity)
+        if self.lsh is not None:
+            self.lsh.compact(live)
+        self._alive = self._new_array("alive", (capacity,), bool)
+        self._alive[:len(live)] = True
+        seqs = np.zeros(capacity, dtype=np.int64)
+        seqs[:len(live)] = self._seqs[live]
+        self._seqs = seqs
+        self._ids = [self._ids[row] for row in live]
+        self._rows = {doc_id: row for row, doc_id in enumerate(self._ids)}
+        self._size = len(live)
+        self._tombstones = 0
+        self.metadata_index = MetadataIndex()
+        self.lexical_index = BM25Index()
+        for row, doc_id in enumerate(self._ids):
+            self.metadata_index.add(row, self.docs[doc_id]["metadata"])
+            self.lexical_index.add(row, self.docs[doc_id]["text"])
+
+    def _compact_matrix(self, live: np.ndarray, capacity: int) -> np.ndarray:
+        matrix = self._new_array("matrix", (capacity, self.width), np.float32)
+        matrix[:len(live)] = self._matrix[live]
+        return matrix
+
+    def _unit_vectors(self, rows) -> np.ndarray:
+        """Stored embeddings of rows, L2-normalized (the space near-duplicates are judged in)"""
+        return normalize_rows(self.vectors(rows)[:, :self.dim])
+
+    def _lsh_index(self) -> LSHIndex:
+        if self.lsh is None:
+            self.lsh = LSHIndex(self.dim)
+            for offset in range(0, self._size, 65536):
+                rows = np.arange(offset, min(offset + 65536, self._size))
+                self.lsh.add(offset, self._unit_vectors(rows))
+        return self.lsh
+
+    def _best_duplicate(self, vector: np.ndarray, rows: np.ndarray, threshold: float) -> Optional[tuple]:
+        """(row, similarity) of the most similar of rows at or above threshold"""
+        if len(rows) == 0:
+            return None
+        similarities = self._unit_vectors(rows) @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < threshold:
+            return None
+        return int(rows[best]), float(similarities[best])
+
+    def near_duplicates(self, embeddings, doc_ids: List[str], threshold: float = DEDUP_THRESHOLD) -> List[Optional[tuple]]:
+        """(duplicate_of, cosine similarity) for each new embedding, or None
+
+        Candidates come from the LSH buckets and are verified exactly. Stored
+        documents are checked first, then earlier items of the same batch. A
+        stored document with the same id is not a duplicate (it is replaced).
+        The batch is hashed once, with the collection's hyperplanes.
+        """
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if self.dim is not None and vectors.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match store dimension {self.dim}")
+        vectors = normalize_rows(vectors)
+        found: List[Optional[tuple]] = [None] * len(vectors)
+        lsh = self._lsh_index() if self.dim is not None else LSHIndex(vectors.shape[1])
+        codes = lsh.hash(vectors)
+        if self.docs:
+            for i, rows in enumerate(lsh.candidates(codes)):
+                rows = rows[self._alive[rows]]
+                rows = rows[[self._ids[row] != doc_ids[i] for row in rows]] if len(rows) else rows
+                match = self._best_duplicate(vectors[i], rows, threshold)
+                if match is not None:
+                    found[i] = (self._ids[match[0]], match[1])
+        batch = LSHIndex(lsh.dim, lsh.bands, lsh.bits, planes=lsh.planes)
+        batch.add_codes(0, codes)
+        for i, rows in enumerate(batch.candidates(codes)):
+            if found[i] is not None:
+                continue
+            rows = rows[rows < i]
+            if len(rows):
+                similarities = vectors[rows] @ vectors[i]
+                best = int(np.argmax(similarities))
+                if similarities[best] >= threshold and doc_ids[rows[best]] != doc_ids[i]:
+                    found[i] = (doc_ids[rows[best]], float(similarities[best]))
+        return found
+
+    def duplicate_clusters(self, threshold: float = DEDUP_THRESHOLD) -> List[List[str]]:
+        """Groups of stored near-duplicates (union of verified LSH pairs), oldest document first"""
+        if not self.docs:
+            return []
+        lsh = self._lsh_index()
+        parent: Dict[int, int] = {}
+
+        def root(row: int) -> int:
+            while parent.get(row, row) != row:
+                parent[row] = parent.get(parent[row], parent[row])
+                row = parent[row]
+            return row
+
+        live = self._live_rows()
+        for offset in range(0, len(live), 4096):
+            rows = live[offset:offset + 4096]
+            vectors = self._unit_vectors(rows)
+            for row, vector, candidates in zip(rows, vectors, lsh.candidates(lsh.codes[rows])):
+                candidates = candidates[candidates > row]
+                candidates = candidates[self._alive[candidates]]
+                if len(candidates) == 0:
+                    continue
+                similarities = self._unit_vectors(candidates) @ vector
+                for other in candidates[similarities >= threshold]:
+                    a, b = root(int(row)), root(int(other))
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+        groups: Dict[int, List[int]] = {}
+        for row in parent:
+            groups.setdefault(root(row), []).append(row)
+        clusters = [sorted(set(rows) | {top}) for top, rows in groups.items()]
+        clusters.sort(key=lambda rows: (-len(rows), rows[0]))
+        return [[self._ids[row] for row in rows] for rows in clusters]
+
+    def list_page(self, after: Optional[int] = None, limit: int = 100) -> tuple:
+        """Up to limit doc ids inserted after sequence number `after`, and the next cursor
+
+        Rows are kept in insertion order (compaction preserves it), so the page
+        start is a binary search over the sequence numbers and a page costs
+        O(limit) plus any tombstones skipped, independent of the corpus size.
+        """
+        start = 0 if after is None else int(np.searchsorted(self._seqs[:self._size], after, side="right"))
+        rows: List[int] = []
+        while start < self._size and len(rows) < limit:
+            chunk = self._alive[start:start + 2 * limit]
+            rows.extend((start + np.flatnonzero(chunk))[:limit - len(rows)].tolist())
+            start += len(chunk)
+        next_cursor = int(self._seqs[rows[-1]]) if len(rows) == limit and rows[-1] + 1 < self._size else None
+        return [self._ids[row] for row in rows], next_cursor
+
+    def _full_precision(self, exact: bool) -> bool:
+        return self._matrix is not None and (self.codec is None or exact)
+
+    def _score_rows(self, queries: np.ndarray, rows, exact: bool = False) -> np.ndarray:
+        """Scores of queries against the given rows (full precision or codec)"""
+        if self._full_precision(exact):
+            return queries @ self._matrix[rows].T
+        return self.codec.score_rows(queries, rows)
+
+    def _score_all(self, queries: np.ndarray, exact: bool = False) -> np.ndarray:
+        if self._full_precision(exact):
+            return queries @ self._matrix[:self._size].T
+        return self.codec.score(queries, self._size)
+
+    def search(
+        self,
+        query_embedding: List[float],
+        top_k: int = 5,
+        threshold: Optional[float] = None,
+        nprobe: Optional[int] = None,
+        exact: bool = False,
+        metadata_filter: Optional[dict] = None,
+        rerank: int = VECTOR_RERANK,
+    ) -> List[tuple]:
+        """Return (doc_id, similarity) pairs for the top_k most similar documents
+
+        A threshold keeps only similarities at or above it; None keeps them all.
+        """
+        return self.search_many([query_embedding], top_k, threshold, nprobe, exact, metadata_filter, rerank)[0]
+
+    def search_many(
+        self,
+        query_embeddings,
+        top_k: int = 5,
+        threshold: Optional[float] = None,
+        nprobe: Optional[int] = None,
+        exact: bool = False,
+        metadata_filter: Optional[dict] = None,
+        rerank: int = VECTOR_RERANK,
+    ) -> List[List[tuple]]:
+        """Search many queries at once, scoring blocks of them with one matrix-matrix product
+
+        A metadata filter is resolved through the inverted index first, and then
+        only the matching rows are scored (exactly, bypassing the ANN index).
+        With quantized storage, rerank * top_k candidates are re-scored against
+        full-precision vectors when those are available; exact searches skip
+        both the ANN index and quantization, and are refused when only the
+        quantized rows are kept.
+        """
+        if len(query_embeddings) == 0:
+            return []
+        if exact and not self._full_precision(exact):
+            raise ValueError(
+                f"Exact search needs full-precision vectors, but this collection only keeps {self.precision} codes "
+                "(set VECTOR_DATA_DIR to keep float32 rows)"
+            )
+        if not self.docs or top_k <= 0:
+            return [[] for _ in query_embeddings]
+        queries = self._as_vectors(query_embeddings, queries=True)
+        if exact or self._full_precision(exact) or self._matrix is None:
+            rerank = 1
+        allowed = None
+        if metadata_filter:
+            allowed = self.metadata_index.match(metadata_filter, self._alive[:self._size])
+            if len(allowed) == 0:
+                return [[] for _ in query_embeddings]
+            if len(allowed) < self._size // 4:
+                return self._search_rows(queries, allowed, top_k, threshold, exact, rerank)
+        k = min(top_k, len(self.docs) if allowed is None else len(allowed))
+        results = []
+        if allowed is None and not exact and self.index is not None and self.index.trained:
+            for query in queries:
+                rows = self.index.candidates(query, nprobe)
+                scores = self._score_rows(query[None, :], rows)[0]
+                results.append(self._select(query, rows, scores, k, threshold, rerank))
+            return results
+        if allowed is None and self._sharded(exact):
+            return self._search_sharded(queries, k, threshold)
+        mask = None
+        if allowed is not None:
+            mask = np.zeros(self._size, dtype=bool)
+            mask[allowed] = True
+        elif self._tombstones:
+            mask = self._alive[:self._size]
+        block_size = max(1, SEARCH_SCORE_BUDGET // self._size)
+        for offset in range(0, len(queries), block_size):
+            block = queries[offset:offset + block_size]
+            scores = self._score_all(block, exact)
+            if mask is not None:
+                scores[:, ~mask] = -np.inf
+            for query, row_scores in zip(block, scores):
+                results.append(self._select(query, None, row_scores, k, threshold, rerank))
+        return results
+
+    def _sharded(self, exact: bool) -> bool:
+        return self.shards is not None and self._size >= SHARD_MIN_ROWS and self._full_precision(exact)
+
+    def _search_sharded(self, queries: np.ndarray, k: int, threshold: Optional[float]) -> List[List[tuple]]:
+        """Full scan scattered over the shard pool; the per-shard top k lists are merged here"""
+        self._release_retired()
+        matrix = self._array_handle("matrix")
+        alive = self._array_handle("alive") if self._tombstones else None
+        results = []
+        block_size = max(1, SEARCH_SCORE_BUDGET * self.shards.workers // self._size)
+        for offset in range(0, len(queries), block_size):
+            block = queries[offset:offset + block_size]
+            rows, scores = self.shards.search(matrix, alive, self._size, block, k)
+            for query, query_rows, query_scores in zip(block, rows, scores):
+                results.append(self._select(query, query_rows, query_scores, k, threshold, 1))
+        return results
+
+    def _search_rows(self, queries: np.ndarray, rows: np.ndarray, top_k: int, threshold: Optional[float], exact: bool, rerank: int) -> List[List[tuple]]:
+        """Search restricted to a (small) set of candidate rows"""
+        k = min(top_k, len(rows))
+        results = []
+        block_size = max(1, SEARCH_SCORE_BUDGET // len(rows))
+        for offset in range(0, len(queries), block_size):
+            block = queries[offset:offset + block_size]
+            scores = self._score_rows(block, rows, exact)
+            for query, row_scores in zip(block, scores):
+                results.append(self._select(query, rows, row_scores, k, threshold, rerank))
+        return results
+
+    def _select(self, query: np.ndarray, rows: Optional[np.ndarray], scores: np.ndarray, k: int, threshold: Optional[float], rerank: int) -> List[tuple]:
+        """Pick the top k rows, re-scoring rerank * k candidates at full precision"""
+        best = top_k_indices(scores, k * max(rerank, 1))
+        best_rows = best if rows is None else rows[best]
+        best_scores = scores[best]
+        if rerank > 1:
+            best_rows = best_rows[self._alive[best_rows]]
+            best_scores = self._matrix[best_rows] @ query
+            order = top_k_indices(best_scores, k)
+            best_rows, best_scores = best_rows[order], best_scores[order]
+        if self.metric == "euclidean":
+            # 2q.x - |x|^2 back to a negated distance, so higher still means closer
+            best_scores = -np.sqrt(np.maximum(np.dot(query[:-1], query[:-1]) / 4 - best_scores, 0.0))
+        return self._collect(best_rows, best_scores, threshold)
+
+    def _collect(self, rows: np.ndarray, scores: np.ndarray, threshold: Optional[float]) -> List[tuple]:
+        return [
+            (self._ids[row], float(score))
+            for row, score in zip(rows, scores)
+            if self._alive[row] and (threshold is None or score >= threshold)
+        ]
+
+    def lexical_search(self, query: str, top_k: int = 5, metadata_filter: Optional[dict] = None) -> List[tuple]:
+        """Return (doc_id, bm25_score) pairs for the top_k lexical matches"""
+        if not self.docs or top_k <= 0:
+            return []
+        mask = self._alive[:self._size]
+        if metadata_filter:
+            mask = np.zeros(self._size, dtype=bool)
+            mask[self.metadata_index.match(metadata_filter, self._alive[:self._size])] = True
+        rows, scores = self.lexical_index.search(query, top_k, self._size, mask)
+        return self._collect(rows, scores, None)
+
+    def hybrid_search(
+        self,
+        query: str,
+        query_embedding: List[float],
+        top_k: int = 5,
+        candidates: int = 50,
+        vector_weight: float = 1.0,
+        lexical_weight: float = 1.0,
+        metadata_filter: Optional[dict] = None,
+        **search_options,
+    ) -> List[dict]:
+        """Fuse vector and BM25 rankings with weighted reciprocal rank fusion"""
+        depth = max(candidates, top_k)
+        vector_matches = self.search(query_embedding, depth, metadata_filter=metadata_filter, **search_options)
+        lexical_matches = self.lexical_search(query, depth, metadata_filter)
+        fused: Dict[str, dict] = {}
+        for source, weight, matches in (("vector", vector_weight, vector_matches), ("lexical", lexical_weight, lexical_matches)):
+            for rank, (doc_id, score) in enumerate(matches, 1):
+                entry = fused.setdefault(doc_id, {"id": doc_id, "score": 0.0})
+                entry["score"] += weight / (RRF_K + rank)
+                entry[f"{source}_score"] = score
+                entry[f"{source}_rank"] = rank
+        return sorted(fused.values(), key=lambda entry: -entry["score"])[:top_k]
+
+    def index_stats(
+        self,
+        k: int = 10,
+        samples: int = 100,
+        nprobe: Optional[int] = None,
+        queries: Optional[List[List[float]]] = None,
+        rerank: int = VECTOR_RERANK,
+    ) -> dict:
+        """Describe the ANN index and storage, and measure recall@k against exact search
+
+        Without full-precision vectors there is no exact baseline, so recall
+        is reported as null instead of comparing the codes with themselves.
+        """
+        stats = self.index.stats() if self.index is not None else {"type": "flat", "memory_bytes": 0}
+        stats["documents"] = len(self.docs)
+        stats["metric"] = self.metric
+        stats["precision"] = self.precision
+        stats["bytes_per_vector"] = self.codec.bytes_per_vector if self.codec is not None else 4 * (self.width if self.dim else 0)
+        stats["codes_bytes"] = self.codec.memory_bytes if self.codec is not None else 0
+        stats["matrix_bytes"] = int(self._matrix.nbytes) if self._matrix is not None else 0
+        stats["full_precision_available"] = self._matrix is not None
+        if not self.docs:
+            return stats
+        if queries is None:
+            rng = np.random.default_rng(0)
+            live = self._live_rows()
+            sample = np.sort(rng.choice(live, min(samples, len(live)), replace=False))
+            queries = self.vectors(sample)
+            if self.metric == "euclidean":
+                queries = queries[:, :-1]
+        measurable = self._full_precision(True)
+        exact_seconds = approx_seconds = 0.0
+        recall = 0.0
+        for query in queries:
+            if measurable:
+                start = time.perf_counter()
+                expected = {doc_id for doc_id, _ in self.search(query, k, exact=True)}
+                exact_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            found = {doc_id for doc_id, _ in self.search(query, k, nprobe=nprobe, rerank=rerank)}
+            approx_seconds += time.perf_counter() - start
+            if measurable:
+                recall += len(expected & found) / max(len(expected), 1)
+        stats.update({
+            "k": k,
+            "queries": len(queries),
+            "recall_at_k": round(recall / len(queries), 4) if measurable else None,
+            "exact_ms_per_query": round(exact_seconds / len(queries) * 1000, 4) if measurable else None,
+            "approx_ms_per_query": round(approx_seconds / len(queries) * 1000, 4),
+        })
+        if not measurable:
+            stats["recall_note"] = "No full-precision vectors to compare against (quantized rows only; set VECTOR_DATA_DIR)"
+        return stats
+
+    def stats(self) -> dict:
+        """Cheap size and configuration summary (no searches are run)"""
+        return {
+            "documents": len(self.docs),
+            "dim": self.dim,
+            "metric": self.metric,
+            "index": self.index.stats()["type"] if self.index is not None else "flat",
+            "precision": self.precision,
+            "rows": self._size,
+            "tombstones": self._tombstones,
+            "matrix_bytes": int(self._matrix.nbytes) if self._matrix is not None else 0,
+            "codes_bytes": self.codec.memory_bytes if self.codec is not None else 0,
+            "index_bytes": self.index.memory_bytes if self.index is not None else 0,
+            "lsh_bytes": self.lsh.memory_bytes if self.lsh is not None else 0,
+            "persistent": False,
+            "shards": self.shards.workers if self.shards is not None else 0,
+        }
+
+    def close(self):
+        """Release resources held by the store (shared-memory segments are unlinked)"""
+        self._matrix = None
+        self._alive = np.zeros(0, dtype=bool)
+        for segment in self._segments.values():
+            segment.unlink()
+            self._retired.append(segment)
+        self._segments = {}
+        self._release_retired()
+
+
+class PersistentVectorStore(VectorStore):
+    """Vector store persisted as a memory-mapped float32 file plus a JSONL write-ahead log
+
+    Every insert and delete is appended to the log (with the vector itself) and
+    fsynced before the call returns. A checkpoint flushes the mapped vectors and
+    rewrites the log with metadata only; compaction additionally rewrites the
+    vector file without tombstoned rows. Both switch generations through an
+    atomically replaced manifest, so a crash leaves either the old or the new
+    generation intact.
+    """
+
+    def __init__(
+        self,
+        data_dir: str,
+        initial_capacity: int = 1024,
+        index: Optional[IVFIndex] = None,
+        precision: str = VECTOR_PRECISION,
+        metric: str = "cosine",
+        shards: Optional[ShardPool] = None,
+    ):
+        super().__init__(initial_capacity, index, precision, metric, shards)
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self._manifest_path = self.data_dir / "manifest.json"
+        self._generation = 0
+        self._vectors_file: Optional[str] = None
+        self._log_file: Optional[str] = None
+        self._log = None
+        self._log_bytes = 0
+        self._load()
+
+    def _load(self):
+        """Map the vector file and replay the log of the current generation"""
+        if not self._manifest_path.exists():
+            return
+        manifest = json.loads(self._manifest_path.read_text())
+        self.dim = manifest["dim"]
+        self._generation = manifest["generation"]
+        self._vectors_file = manifest["vectors"]
+        self._log_file = manifest["log"]
+        self._map_vectors(os.path.getsize(self.data_dir / self._vectors_file) // (self.width * 4))
+        self._alive = self._new_array("alive", (self._matrix.shape[0],), bool)
+        self._seqs = np.zeros(self._matrix.shape[0], dtype=np.int64)
+        valid_bytes = 0
+        with open(self.data_dir / self._log_file, "rb") as log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # torn write at the tail of the log
+                valid_bytes += len(line)
+                self._replay(record)
+        self._tombstones = self._size - len(self._rows)
+        self._storage_ready = True
+        self.codec = make_codec(self.precision, self.width, self.width - self.dim)
+        if self.codec is not None:
+            # Rows the saved codec covers are mapped as they are; only rows
+            # logged since that generation are encoded again
+            encoded = self._restore_codec(manifest.get("codec"))
+            if self.codec.capacity != len(self._alive):
+                self.codec.resize(len(self._alive))
+            for offset in range(encoded, self._size, 65536):
+                self.codec.set(offset, np.asarray(self._matrix[offset:min(offset + 65536, self._size)]))
+        self._log = open(self.data_dir / self._log_file, "r+b")
+        self._log.truncate(valid_bytes)
+        self._log.seek(valid_bytes)
+        self._log_bytes = valid_bytes
+        self._remove_stale_files(manifest)
+        if self.index is not None and len(self.docs) >= self.index.min_train_size:
+            self.index.train(self.vectors, self._live_rows())
+
+    def _replay(self, record: dict):
+        doc_id = record["id"]
+        if record["op"] == "put":
+            row = record["row"]
+            self._ensure_capacity(row + 1)
+            if "vector" in record:
+                self._matrix[row] = np.frombuffer(base64.b64decode(record["vector"]), dtype=np.float32)
+            if doc_id in self._rows:
+                self._tombstone(doc_id)
+            self._ids.extend([None] * (row + 1 - len(self._ids)))
+            self._ids[row] = doc_id
+            self._alive[row] = True
+            self._seqs[row] = record.get("seq", row)
+            self._next_seq = max(self._next_seq, int(self._seqs[row]) + 1)
+            self._rows[doc_id] = row
+            self._size = max(self._size, row + 1)
+            self.docs[doc_id] = {"id": doc_id, "text": record["text"], "metadata": record["metadata"]}
+            self.metadata_index.add(row, record["metadata"])
+            self.lexical_index.add(row, record["text"])
+        elif record["op"] == "delete" and doc_id in self._rows:
+            self._tombstone(doc_id)
+            del self.docs[doc_id]
+
+    def _restore_codec(self, saved: Optional[dict]) -> int:
+        """Map the codec arrays saved with this generation; the number of rows they cover"""
+        if not saved or saved["precision"] != self.codec.name:
+            return 0
+        state = {name: np.load(self.data_dir / file, mmap_mode="c") for name, file in saved["arrays"].items()}
+        self.codec.restore(state, saved["rows"])
+        return saved["rows"]
+
+    def _save_codec(self) -> Optional[dict]:
+        """Write the codec arrays for the current generation; their manifest entry"""
+        if self.codec is None:
+            return None
+        files = {}
+        for name, array in self.codec.state().items():
+            files[name] = f"codec.{self._generation}.{name}.npy"
+            with open(self.data_dir / files[name], "wb") as f:
+                np.save(f, array)
+                f.flush()
+                os.fsync(f.fileno())
+        return {"precision": self.codec.name, "rows": self._size, "arrays": files}
+
+    def _remove_stale_files(self, manifest: dict):
+        """Delete vector, log and codec files of other generations"""
+        keep = {manifest["vectors"], manifest["log"], *manifest.get("codec", {}).get("arrays", {}).values()}
+        for path in self.data_dir.glob("*.*"):
+            if path.name.startswith(("vectors.", "wal.", "codec.")) and path.name not in keep:
+                path.unlink()
+
+    def _map_vectors(self, capacity: int):
+        """(Re)map the vector file, growing it to hold capacity rows"""
+        path = self.data_dir / self._vectors_file
+        self._matrix = None
+        with open(path, "r+b" if path.exists() else "w+b") as f:
+            if os.fstat(f.fileno()).st_size < capacity * self.width * 4:
+                f.truncate(capacity * self.width * 4)
+        self._matrix = np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, self.width))
+
+    def _init_storage(self):
+        self.codec = make_codec(self.precision, self.width, self.width - self.dim)
+
+    def _resize_matrix(self, capacity: int):
+        if self._vectors_file is None:
+            self._vectors_file = "vectors.0.f32"
+            self._map_vectors(capacity)
+            self._write_generation(self._vectors_file)
+        else:
+            self._matrix.flush()
+            self._map_vectors(capacity)
+
+    def _array_handle(self, role: str) -> tuple:
+        if role == "matrix":
+            return ("file", str(self.data_dir / self._vectors_file), self._matrix.shape, "<f4")
+        return super()._array_handle(role)
+
+    def _append_log(self, records: List[dict]):
+        """Durably append records to the write-ahead log"""
+        data = b"".join(json.dumps(record).encode() + b"\n" for record in records)
+        self._log.write(data)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._log_bytes += len(data)
+
+    def _put_record(self, doc_id: str, with_vector: bool) -> dict:
+        row = self._rows[doc_id]
+        doc = self.docs[doc_id]
+        record = {"op": "put", "id": doc_id, "row": row, "seq": int(self._seqs[row]), "text": doc["text"], "metadata": doc["metadata"]}
+        if with_vector:
+            record["vector"] = base64.b64encode(np.ascontiguousarray(self._matrix[row]).tobytes()).decode("ascii")
+        return record
+
+    def add_many(self, items: List[tuple]):
+        super().add_many(items)
+        doc_ids = dict.fromkeys(doc_id for doc_id, _, _, _ in items)
+        self._append_log([self._put_record(doc_id, with_vector=True) for doc_id in doc_ids])
+        if self._log_bytes > VECTOR_CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    def delete(self, doc_id: str) -> bool:
+        if doc_id not in self._rows:
+            return False
+        self._append_log([{"op": "delete", "id": doc_id}])
+        return super().delete(doc_id)
+
+    def _compact_matrix(self, live: np.ndarray, capacity: int) -> np.ndarray:
+        """Copy live rows into a new vector file, chunk by chunk"""
+        self._vectors_file = f"vectors.{self._generation + 1}.f32"
+        path = self.data_dir / self._vectors_file
+        matrix = np.memmap(path, dtype=np.float32, mode="w+", shape=(capacity, self.width))
+        for offset in range(0, len(live), 65536):
+            chunk = live[offset:offset + 65536]
+            matrix[offset:offset + len(chunk)] = self._matrix[chunk]
+        return matrix
+
+    def compact(self):
+        """Rewrite the vector file and log without tombstoned rows"""
+        super().compact()
+        self._write_generation(self._vectors_file)
+
+    def checkpoint(self):
+        """Flush mapped vectors and rewrite the log without vector payloads"""
+        self._write_generation(self._vectors_file)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["persistent"] = True
+        stats["generation"] = self._generation
+        stats["log_bytes"] = self._log_bytes
+        return stats
+
+    def close(self):
+        """Flush mapped vectors and close the write-ahead log"""
+        if self._matrix is not None:
+            self._matrix.flush()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        super().close()
+
+    def _write_generation(self, vectors_file: str):
+        """Flush vectors, save the codec arrays, write a metadata-only log and switch the manifest to them"""
+        self._matrix.flush()
+        self._generation += 1
+        log_file = f"wal.{self._generation}.jsonl"
+        log = open(self.data_dir / log_file, "w+b")
+        self._log, old_log = log, self._log
+        self._log_bytes = 0
+        self._append_log([self._put_record(self._ids[row], with_vector=False) for row in self._live_rows()])
+        self._log_bytes = 0
+        manifest = {"generation": self._generation, "dim": self.dim, "vectors": vectors_file, "log": log_file}
+        codec = self._save_codec()
+        if codec is not None:
+            manifest["codec"] = codec
+        tmp_path = self._manifest_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._manifest_path)
+        if old_log is not None:
+            old_log.close()
+        self._remove_stale_files(manifest)
+        self._log_file = log_file
+
+
+class EmbeddingCache:
+    """LRU cache of embeddings keyed by (model, text hash) with an optional SQLite disk tier"""
+
+    def __init__(self, max_bytes: int = EMBEDDING_CACHE_BYTES, disk_dir: str = EMBEDDING_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        if disk_dir:
+            Path(disk_dir).mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(Path(disk_dir) / "embeddings.sqlite3"))
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return f"{model}:{hashlib.sha256(text.encode()).hexdigest()}"
+
+    def _remember(self, key: str, embedding: np.ndarray):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        size = embedding.nbytes + len(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = embedding
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old_key, old = self._entries.popitem(last=False)
+            self.bytes -= old.nbytes + len(old_key)
+            self.evictions += 1
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Look texts up in memory, then on disk; None marks a miss"""
+        keys = [self.key(model, text) for text in texts]
+        found: List[Optional[np.ndarray]] = []
+        for key in keys:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            found.append(embedding)
+        missing = [key for key, embedding in zip(keys, found) if embedding is None]
+        if missing and self._db is not None:
+            stored = {}
+            for offset in range(0, len(missing), 500):
+                chunk = missing[offset:offset + 500]
+                placeholders = ",".join("?" * len(chunk))
+                for key, blob in self._db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk):
+                    stored[key] = np.frombuffer(blob, dtype=np.float32)
+            for i, key in enumerate(keys):
+                if found[i] is None and key in stored:
+                    found[i] = stored[key]
+                    self._remember(key, stored[key])
+                    self.disk_hits += 1
+        self.misses += sum(1 for embedding in found if embedding is None)
+        return found
+
+    def put_many(self, model: str, texts: List[str], embeddings: List[np.ndarray]):
+        keys = [self.key(model, text) for text in texts]
+        for key, embedding in zip(keys, embeddings):
+            self._remember(key, embedding)
+        if self._db is not None:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, embedding.tobytes()) for key, embedding in zip(keys, embeddings)],
+                )
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        stats = {
+            "model": embedder.name,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+        }
+        if self._db is not None:
+            stats["disk_entries"] = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return stats
+
+
+class EmbeddingBackend:
+    """Common batch interface for embedding backends"""
+
+    name = "base"
+    batch_size = 1024
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class HashingEmbedder(EmbeddingBackend):
+    """Local embedder: token n-grams feature-hashed into a fixed dimension
+
+    Each n-gram is hashed with CRC32 (stable across processes) to a bucket and
+    a sign. The signed counts c of each bucket (colliding n-grams may cancel)
+    are damped to sign(c) * log(1 + |c|) before the rows are L2-normalized.
+    The whole batch is scattered with one bincount.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, max_ngram: int = HASHING_MAX_NGRAM):
+        self.dim = dim
+        self.max_ngram = max_ngram
+        self.name = f"hashing-{dim}-{max_ngram}"
+        self._hashes: Dict[str, int] = {}
+
+    def _hash(self, feature: str) -> int:
+        h = self._hashes.get(feature)
+        if h is None:
+            h = zlib.crc32(feature.encode())
+            if len(self._hashes) < 1_000_000:
+                self._hashes[feature] = h
+        return h
+
+    def features(self, text: str) -> List[int]:
+        """Hashes of all token n-grams of the text"""
+        tokens = tokenize(text)
+        hashes = [self._hash(token) for token in tokens]
+        for n in range(2, self.max_ngram + 1):
+            hashes.extend(self._hash(" ".join(tokens[i:i + n])) for i in range(len(tokens) - n + 1))
+        return hashes
+
+    def embed_sync(self, texts: List[str]) -> np.ndarray:
+        doc_rows = []
+        hashes = []
+        for row, text in enumerate(texts):
+            features = self.features(text)
+            hashes.extend(features)
+            doc_rows.append(np.full(len(features), row, dtype=np.int64))
+        if not hashes:
+            return np.zeros((len(texts), self.dim), dtype=np.float32)
+        hashes = np.asarray(hashes, dtype=np.int64)
+        buckets = np.concatenate(doc_rows) * self.dim + hashes % self.dim
+        signs = np.where(hashes & 0x80000000, -1.0, 1.0)
+        counts = np.bincount(buckets, weights=signs, minlength=len(texts) * self.dim)
+        weights = np.sign(counts) * np.log1p(np.abs(counts))
+        return normalize_rows(weights.reshape(len(texts), self.dim).astype(np.float32))
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        return self.embed_sync(texts)
+
+
+class OpenAIEmbedder(EmbeddingBackend):
+    """Remote embedder backed by the OpenAI embeddings API"""
+
+    batch_size = 2048
+
+    def __init__(self, model: str = OPENAI_EMBEDDING_MODEL):
+        self.model = model
+        self.name = f"openai-{model}"
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        import httpx
+        if not OPENAI_API_KEY:
+            raise ValueError("OPENAI_API_KEY is not set")
+        headers = {
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "Content-Type": "application/json",
+        }
+        rows = []
+        async with httpx.AsyncClient() as client:
+            for offset in range(0, len(texts), self.batch_size):
+                response = await client.post(
+                    "https://api.openai.com/v1/embeddings",
+                    headers=headers,
+                    json={"model": self.model, "input": texts[offset:offset + self.batch_size]},
+                    timeout=60.0,
+                )
+                response.raise_for_status()
+                data = sorted(response.json()["data"], key=lambda item: item["index"])
+                rows.extend(item["embedding"] for item in data)
+        return np.asarray(rows, dtype=np.float32)
+
+
+search_pool = ShardPool(SEARCH_WORKERS) if SEARCH_WORKERS > 0 else None
+collections: Dict[str, VectorStore] = {}
+collection_configs: Dict[str, dict] = {}
+
+
+def collection_config(options: dict) -> dict:
+    """Validated collection settings, defaulting to the server-wide configuration"""
+    config = {
+        "metric": options.get("metric") or "cosine",
+        "index": options.get("index") or VECTOR_INDEX,
+        "precision": options.get("precision") or VECTOR_PRECISION,
+        "nlist": int(options.get("nlist", IVF_NLIST)),
+        "nprobe": int(options.get("nprobe", IVF_NPROBE)),
+        "dim": int(options["dim"]) if options.get("dim") else None,
+    }
+    if config["metric"] not in VECTOR_METRICS:
+        raise ValueError(f"Unknown metric: {config['metric']} (expected one of {', '.join(VECTOR_METRICS)})")
+    if config["index"] not in ("flat", "ivf"):
+        raise ValueError(f"Unknown index type: {config['index']} (expected flat or ivf)")
+    if config["precision"] not in VECTOR_PRECISIONS:
+        raise ValueError(f"Unknown vector precision: {config['precision']}")
+    return config
+
+
+def open_collection(name: str, config: dict) -> VectorStore:
+    index = IVFIndex(nlist=config["nlist"], nprobe=config["nprobe"]) if config["index"] == "ivf" else None
+    if VECTOR_DATA_DIR:
+        store: VectorStore = PersistentVectorStore(
+            str(Path(VECTOR_DATA_DIR) / name), index=index, precision=config["precision"], metric=config["metric"], shards=search_pool
+        )
+    else:
+        store = VectorStore(index=index, precision=config["precision"], metric=config["metric"], shards=search_pool)
+    if store.dim is None:
+        store.dim = config["dim"]
+    return store
+
+
+def create_collection(name: str, options: Optional[dict] = None) -> VectorStore:
+    """Create a named collection (persisted under VECTOR_DATA_DIR/<name> when durable)"""
+    if not COLLECTION_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid collection name: {name!r} (use 1-64 letters, digits, '_' or '-')")
+    if name in collections:
+        raise ValueError(f"Collection already exists: {name}")
+    config = collection_config(options or {})
+    store = open_collection(name, config)
+    if VECTOR_DATA_DIR:
+        (Path(VECTOR_DATA_DIR) / name / "collection.json").write_text(json.dumps(config))
+    collections[name] = store
+    collection_configs[name] = config
+    return store
+
+
+def get_collection(name: Optional[str], create: bool = False) -> VectorStore:
+    """Look a collection up by name; writes create missing collections with defaults"""
+    name = name or DEFAULT_COLLECTION
+    if name not in collections:
+        if not create:
+            raise ValueError(f"Collection not found: {name}")
+        return create_collection(name)
+    return collections[name]
+
+
+def drop_collection(name: str) -> bool:
+    """Remove a collection and its files, returning False if it does not exist"""
+    store = collections.pop(name, None)
+    if store is None:
+        return False
+    del collection_configs[name]
+    store.close()
+    if VECTOR_DATA_DIR:
+        shutil.rmtree(Path(VECTOR_DATA_DIR) / name, ignore_errors=True)
+    return True
+
+
+def load_collections():
+    """Open every collection persisted under VECTOR_DATA_DIR, plus the default one"""
+    if VECTOR_DATA_DIR:
+        for path in sorted(Path(VECTOR_DATA_DIR).glob("*/collection.json")):
+            config = json.loads(path.read_text())
+            collections[path.parent.name] = open_collection(path.parent.name, config)
+            collection_configs[path.parent.name] = config
+    if DEFAULT_COLLECTION not in collections:
+        create_collection(DEFAULT_COLLECTION)
+
+
+load_collections()
+
+
+def make_embedder(backend: str) -> EmbeddingBackend:
+    """Embedding backend selected by VECTOR_EMBEDDER"""
+    if backend == "hashing":
+        return HashingEmbedder()
+    if backend == "openai":
+        return OpenAIEmbedder()
+    raise ValueError(f"Unknown embedding backend: {backend}")
+
+
+embedder = make_embedder(VECTOR_EMBEDDER)
+embeddings_cache = EmbeddingCache()
+
+
+async def generate_embedding(text: str) -> np.ndarray:
+    """Generate embedding for text, served from the embedding cache when possible"""
+    return (await generate_embeddings([text]))[0]
+
+
+async def generate_embeddings(texts: List[str]) -> np.ndarray:
+    """Generate embeddings for many texts, computing each distinct cache miss once"""
+    embeddings = embeddings_cache.get_many(embedder.name, texts)
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if missing:
+        computed = []
+        for offset in range(0, len(missing), embedder.batch_size):
+            # Copy the rows so a cached embedding does not keep its whole batch array alive
+            batch = await embedder.embed(missing[offset:offset + embedder.batch_size])
+            computed.extend(np.array(row, copy=True) for row in batch)
+        embeddings_cache.put_many(embedder.name, missing, computed)
+        by_text = dict(zip(missing, computed))
+        embeddings = [by_text[text] if embedding is None else embedding for text, embedding in zip(texts, embeddings)]
+    if not embeddings:
+        return np.zeros((0, getattr(embedder, "dim", 0)), dtype=np.float32)
+    return np.stack(embeddings)
+
+
+async def read_blocks(path: str, block_size: int = INGEST_READ_BYTES) -> AsyncIterator[str]:
+    """Read a text file block by block without blocking the event loop"""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        while True:
+            block = await asyncio.to_thread(f.read, block_size)
+            if not block:
+                return
+            yield block
+
+
+async def text_blocks(text: str, block_size: int = INGEST_READ_BYTES) -> AsyncIterator[str]:
+    for offset in range(0, len(text), block_size):
+        yield text[offset:offset + block_size]
+
+
+async def sliding_chunks(blocks: AsyncIterator[str], chunk_size: int, overlap: int) -> AsyncIterator[tuple]:
+    """Yield (char_offset, chunk) windows of at most chunk_size characters overlapping by overlap
+
+    A window ends at the last whitespace in its second half when there is one,
+    so words are not split. Only about one block plus one window is buffered.
+    """
+    if chunk_size <= 0 or not 0 <= overlap < chunk_size:
+        raise ValueError("chunk_size must be positive and chunk_overlap between 0 and chunk_size")
+    buffer = ""
+    offset = 0
+    async for block in blocks:
+        buffer += block
+        while len(buffer) > chunk_size:
+            end = chunk_size
+            cut = max(buffer.rfind(space, chunk_size // 2, chunk_size) for space in (" ", "\n", "\t"))
+            if cut > overlap:
+                end = cut
+            if buffer[:end].strip():
+                yield offset, buffer[:end]
+            step = end - overlap
+            buffer = buffer[step:]
+            offset += step
+    if buffer.strip() and (offset == 0 or len(buffer) > overlap):
+        yield offset, buffer
+
+
+async def ingest_document(
+    store: VectorStore,
+    doc_id: str,
+    blocks: AsyncIterator[str],
+    metadata: Optional[dict] = None,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+    overlap: int = INGEST_CHUNK_OVERLAP,
+    batch_size: int = INGEST_BATCH_SIZE,
+) -> dict:
+    """Chunk, embed and store a document as "<doc_id>#<n>" chunks
+
+    The chunker runs as its own task and hands batches to the embedder through
+    a bounded queue, so reading, embedding and storing overlap while memory
+    stays flat however long the document is. Stale chunks left over from a
+    previous, longer version of the document are deleted afterwards.
+    """
+    started = time.perf_counter()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=INGEST_QUEUE_DEPTH)
+
+    async def produce():
+        try:
+            batch = []
+            async for start, chunk in sliding_chunks(blocks, chunk_size, overlap):
+                batch.append((start, chunk))
+                if len(batch) >= batch_size:
+                    await queue.put(batch)
+                    batch = []
+            if batch:
+                await queue.put(batch)
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.ensure_future(produce())
+    chunks = characters = 0
+    try:
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                break
+            embeddings = await generate_embeddings([chunk for _, chunk in batch])
+            items = []
+            for (start, chunk), embedding in zip(batch, embeddings):
+                chunk_metadata = dict(metadata or {})
+                chunk_metadata.update({"parent_id": doc_id, "chunk_index": chunks, "char_start": start, "char_end": start + len(chunk)})
+                items.append((f"{doc_id}#{chunks}", chunk, embedding, chunk_metadata))
+                chunks += 1
+                characters = start + len(chunk)
+            store.add_many(items)
+        await producer
+    finally:
+        producer.cancel()
+    stale = chunks
+    while store.delete(f"{doc_id}#{stale}"):
+        stale += 1
+    seconds = time.perf_counter() - started
+    return {
+        "status": "ingested",
+        "id": doc_id,
+        "chunks": chunks,
+        "characters": characters,
+        "stale_chunks_deleted": stale - chunks,
+        "seconds": round(seconds, 4),
+        "chunks_per_second": round(chunks / seconds, 1) if seconds > 0 else 0.0,
+    }
+
+
+def store_documents(store: VectorStore, items: List[tuple], dedup: str = VECTOR_DEDUP, threshold: float = DEDUP_THRESHOLD) -> List[dict]:
+    """Add (doc_id, text, embedding, metadata) items, flagging or rejecting near-duplicates
+
+    Returns one {id, duplicate_of, similarity, action} entry per near-duplicate found.
+    """
+    if dedup not in ("off", "flag", "reject"):
+        raise ValueError(f"Unknown dedup mode: {dedup} (expected off, flag or reject)")
+    duplicates = []
+    if dedup != "off" and items:
+        matches = store.near_duplicates([embedding for _, _, embedding, _ in items], [doc_id for doc_id, _, _, _ in items], threshold)
+        kept = []
+        for item, match in zip(items, matches):
+            if match is None:
+                kept.append(item)
+                continue
+            duplicates.append({
+                "id": item[0],
+                "duplicate_of": match[0],
+                "similarity": round(match[1], 4),
+                "action": "rejected" if dedup == "reject" else "flagged",
+            })
+            if dedup == "flag":
+                kept.append(item)
+        items = kept
+    store.add_many(items)
+    return duplicates
+
+
+def format_matches(store: VectorStore, matches: List[tuple]) -> List[dict]:
+    """Attach document text and metadata to (doc_id, similarity) pairs"""
+    results = []
+    for doc_id, similarity in matches:
+        doc = store.docs[doc_id]
+        results.append({
+            "id": doc_id,
+            "text": doc["text"],
+            "similarity": similarity,
+            "metadata": doc.get("metadata", {}),
+        })
+    return results
 
 
 @server.list_tools()
@@ -63,6 +2204,9 @@ async def list_tools() -> list[Tool]:
                     "text": {"type": "string", "description": "Document text"},
                     "metadata": {"type": "object", "description": "Additional metadata"},
                     "embedding": {"type": "array", "items": {"type": "number"}, "description": "Optional pre-computed embedding"},
+                    "dedup": {"type": "string", "enum": ["off", "flag", "reject"], "description": "Near-duplicate handling", "default": VECTOR_DEDUP},
+                    "dedup_threshold": {"type": "number", "description": "Cosine similarity at which documents count as near-duplicates", "default": DEDUP_THRESHOLD},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
                 },
                 "required": ["id", "text"],
             },
@@ -70,16 +2214,103 @@ async def list_tools() -> list[Tool]:
         Tool(
             name="vector_search",
             description="Search for similar documents",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "Search query"},
+                    "embedding": {"type": "array", "items": {"type": "number"}, "description": "Optional pre-computed query embedding (used instead of embedding the query)"},
+                    "top_k": {"type": "number", "description": "Number of results to return", "default": 5},
+                    "threshold": {"type": "number", "description": "Minimum similarity to return (cosine/dot score, or negated distance for euclidean); omitted returns all top_k"},
+                    "nprobe": {"type": "number", "description": "IVF lists to probe (higher = better recall, slower)"},
+                    "exact": {"type": "boolean", "description": "Bypass the ANN index and quantization and scan every vector (needs full-precision vectors; an error for quantized-only collections)", "default": False},
+                    "rerank": {"type": "number", "description": "With quantized storage, re-score rerank * top_k candidates at full precision", "default": VECTOR_RERANK},
+                    "filter": {"type": "object", "description": "Metadata filter: {field: value}, {field: {\"$in\": [...]}} or {field: {\"$gte\": x, \"$lt\": y}}"},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
+                },
+                "required": ["query"],
+            },
+        ),
+        Tool(
+            name="vector_store_batch",
+            description="Store many documents in one call (missing embeddings are generated in batch)",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "documents": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "id": {"type": "string", "description": "Unique document ID"},
+                                "text": {"type": "string", "description": "Document text"},
+                                "metadata": {"type": "object", "description": "Additional metadata"},
+                                "embedding": {"type": "array", "items": {"type": "number"}, "description": "Optional pre-computed embedding"},
+                            },
+                            "required": ["id", "text"],
+                        },
+                        "description": "Documents to store",
+                    },
+                    "dedup": {"type": "string", "enum": ["off", "flag", "reject"], "description": "Near-duplicate handling", "default": VECTOR_DEDUP},
+                    "dedup_threshold": {"type": "number", "description": "Cosine similarity at which documents count as near-duplicates", "default": DEDUP_THRESHOLD},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
+                },
+                "required": ["documents"],
+            },
+        ),
+        Tool(
+            name="vector_search_batch",
+            description="Run many similarity searches in one call",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "queries": {"type": "array", "items": {"type": "string"}, "description": "Search queries"},
+                    "embeddings": {"type": "array", "items": {"type": "array", "items": {"type": "number"}}, "description": "Optional pre-computed query embeddings (used instead of embedding the queries)"},
+                    "top_k": {"type": "number", "description": "Number of results to return per query", "default": 5},
+                    "threshold": {"type": "number", "description": "Minimum similarity to return (cosine/dot score, or negated distance for euclidean); omitted returns all top_k"},
+                    "nprobe": {"type": "number", "description": "IVF lists to probe (higher = better recall, slower)"},
+                    "exact": {"type": "boolean", "description": "Bypass the ANN index and quantization and scan every vector (needs full-precision vectors; an error for quantized-only collections)", "default": False},
+                    "rerank": {"type": "number", "description": "With quantized storage, re-score rerank * top_k candidates at full precision", "default": VECTOR_RERANK},
+                    "filter": {"type": "object", "description": "Metadata filter: {field: value}, {field: {\"$in\": [...]}} or {field: {\"$gte\": x, \"$lt\": y}}"},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
+                },
+                "required": ["queries"],
+            },
+        ),
+        Tool(
+            name="vector_hybrid_search",
+            description="Search by fusing vector similarity and BM25 keyword ranking (reciprocal rank fusion)",
             inputSchema={
                 "type": "object",
                 "properties": {
                     "query": {"type": "string", "description": "Search query"},
                     "top_k": {"type": "number", "description": "Number of results to return", "default": 5},
-                    "threshold": {"type": "number", "description": "Minimum similarity threshold", "default": 0.0},
+                    "candidates": {"type": "number", "description": "Results taken from each ranking before fusion", "default": 50},
+                    "vector_weight": {"type": "number", "description": "Weight of the vector ranking", "default": 1.0},
+                    "lexical_weight": {"type": "number", "description": "Weight of the BM25 ranking", "default": 1.0},
+                    "filter": {"type": "object", "description": "Metadata filter (same syntax as vector_search)"},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
                 },
                 "required": ["query"],
             },
         ),
+        Tool(
+            name="vector_ingest",
+            description="Chunk a long text or text file with a sliding window, embed the chunks in batches and store them",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string", "description": "Parent document ID (chunks are stored as <id>#<n>)"},
+                    "text": {"type": "string", "description": "Document text"},
+                    "path": {"type": "string", "description": "Path of a UTF-8 text file to stream instead of text"},
+                    "metadata": {"type": "object", "description": "Metadata copied to every chunk"},
+                    "chunk_size": {"type": "number", "description": "Maximum chunk length in characters", "default": INGEST_CHUNK_SIZE},
+                    "chunk_overlap": {"type": "number", "description": "Characters shared by consecutive chunks", "default": INGEST_CHUNK_OVERLAP},
+                    "batch_size": {"type": "number", "description": "Chunks embedded and stored per batch", "default": INGEST_BATCH_SIZE},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
+                },
+                "required": ["id"],
+            },
+        ),
         Tool(
             name="vector_get_embedding",
             description="Get embedding for text",
@@ -98,17 +2329,102 @@ async def list_tools() -> list[Tool]:
                 "type": "object",
                 "properties": {
                     "id": {"type": "string", "description": "Document ID to delete"},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
                 },
                 "required": ["id"],
             },
         ),
         Tool(
             name="vector_list",
-            description="List all documents in the vector store",
+            description="List documents in insertion order, one cursor-paginated page at a time",
             inputSchema={
                 "type": "object",
                 "properties": {
                     "limit": {"type": "number", "description": "Maximum number of documents to return", "default": 100},
+                    "cursor": {"type": "string", "description": "next_cursor from the previous page"},
+                    "fields": {
+                        "type": "array",
+                        "items": {"type": "string", "enum": ["id", "text", "metadata"]},
+                        "description": "Fields to return per document (default: all)",
+                    },
+                    "mode": {
+                        "type": "string",
+                        "enum": ["documents", "count", "stats"],
+                        "description": "documents (a page), count (document count only) or stats (collection stats)",
+                        "default": "documents",
+                    },
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
+                },
+            },
+        ),
+        Tool(
+            name="vector_cache_stats",
+            description="Report embedding cache size and hit/miss counters",
+            inputSchema={"type": "object", "properties": {}},
+        ),
+        Tool(
+            name="vector_index_stats",
+            description="Report ANN index build time, memory per vector and measured recall against exact search",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "k": {"type": "number", "description": "Recall is measured at this k", "default": 10},
+                    "samples": {"type": "number", "description": "Stored vectors sampled as queries", "default": 100},
+                    "nprobe": {"type": "number", "description": "IVF lists to probe while measuring recall"},
+                    "rerank": {"type": "number", "description": "Full-precision re-ranking factor while measuring recall", "default": VECTOR_RERANK},
+                    "queries": {"type": "array", "items": {"type": "string"}, "description": "Optional query texts to measure recall with"},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
+                },
+            },
+        ),
+        Tool(
+            name="vector_find_duplicates",
+            description="Cluster stored near-duplicate documents (LSH candidates verified by cosine similarity), optionally deleting all but the oldest of each cluster",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "threshold": {"type": "number", "description": "Cosine similarity at which documents count as near-duplicates", "default": DEDUP_THRESHOLD},
+                    "delete": {"type": "boolean", "description": "Delete every duplicate except the oldest document of each cluster", "default": False},
+                    "limit": {"type": "number", "description": "Maximum number of clusters to return", "default": 100},
+                    "collection": {"type": "string", "description": "Collection name", "default": DEFAULT_COLLECTION},
+                },
+            },
+        ),
+        Tool(
+            name="vector_create_collection",
+            description="Create a named collection with its own metric, index type and storage precision",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string", "description": "Collection name (letters, digits, '_' or '-')"},
+                    "metric": {"type": "string", "enum": list(VECTOR_METRICS), "description": "Similarity metric", "default": "cosine"},
+                    "index": {"type": "string", "enum": ["flat", "ivf"], "description": "Index type", "default": VECTOR_INDEX},
+                    "precision": {"type": "string", "enum": list(VECTOR_PRECISIONS), "description": "Storage precision", "default": VECTOR_PRECISION},
+                    "dim": {"type": "number", "description": "Embedding dimension (default: taken from the first insert)"},
+                    "nlist": {"type": "number", "description": "IVF lists (0 = sqrt(corpus size))", "default": IVF_NLIST},
+                    "nprobe": {"type": "number", "description": "IVF lists probed by default", "default": IVF_NPROBE},
+                },
+                "required": ["name"],
+            },
+        ),
+        Tool(
+            name="vector_drop_collection",
+            description="Delete a collection and all of its documents",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string", "description": "Collection name"},
+                },
+                "required": ["name"],
+            },
+        ),
+        Tool(
+            name="vector_collection_stats",
+            description="Report document count, configuration and memory use of one or all collections",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string", "description": "Collection name (omit for all collections)"},
                 },
             },
         ),
@@ -130,65 +2446,217 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
             else:
                 embedding = await generate_embedding(text)
             
-            vector_store[doc_id] = {
-                "id": doc_id,
-                "text": text,
-                "embedding": embedding,
-                "metadata": metadata,
-            }
+            duplicates = store_documents(
+                get_collection(arguments.get("collection"), create=True),
+                [(doc_id, text, embedding, metadata)],
+                arguments.get("dedup", VECTOR_DEDUP),
+                float(arguments.get("dedup_threshold", DEDUP_THRESHOLD)),
+            )
+            result = {"status": "stored", "id": doc_id}
+            if duplicates:
+                result.update(duplicates[0])
+                result["status"] = "duplicate" if duplicates[0]["action"] == "rejected" else "stored"
+                del result["action"]
             
-            return [TextContent(type="text", text=json.dumps({"status": "stored", "id": doc_id}, indent=2))]
+            return [TextContent(type="text", text=json.dumps(result, indent=2))]
+        
+        elif name == "vector_store_batch":
+            documents = arguments["documents"]
+            missing = [doc for doc in documents if "embedding" not in doc]
+            if missing:
+                embeddings = await generate_embeddings([doc["text"] for doc in missing])
+                for doc, embedding in zip(missing, embeddings):
+                    doc["embedding"] = embedding
+            duplicates = store_documents(
+                get_collection(arguments.get("collection"), create=True),
+                [(doc["id"], doc["text"], doc["embedding"], doc.get("metadata", {})) for doc in documents],
+                arguments.get("dedup", VECTOR_DEDUP),
+                float(arguments.get("dedup_threshold", DEDUP_THRESHOLD)),
+            )
+            rejected = sum(1 for duplicate in duplicates if duplicate["action"] == "rejected")
+            result = {"status": "stored", "count": len(documents) - rejected}
+            if duplicates:
+                result["duplicates"] = duplicates
+            return [TextContent(type="text", text=json.dumps(result, indent=2))]
         
         elif name == "vector_search":
+            store = get_collection(arguments.get("collection"))
             query = arguments["query"]
             top_k = arguments.get("top_k", 5)
-            threshold = arguments.get("threshold", 0.0)
-            
-            # Generate query embedding
-            query_embedding = await generate_embedding(query)
+            threshold = arguments.get("threshold")
             
-            # Calculate similarities
-            results = []
-            for doc_id, doc in vector_store.items():
-                similarity = cosine_similarity(query_embedding, doc["embedding"])
-                if similarity >= threshold:
-                    results.append({
-                        "id": doc_id,
-                        "text": doc["text"],
-                        "similarity": similarity,
-                        "metadata": doc.get("metadata", {}),
-                    })
+            # Generate or use provided query embedding
+            if "embedding" in arguments:
+                query_embedding = arguments["embedding"]
+            else:
+                query_embedding = await generate_embedding(query)
             
-            # Sort by similarity and return top_k
-            results.sort(key=lambda x: x["similarity"], reverse=True)
-            results = results[:top_k]
+            # Score the whole matrix (or the ANN candidate rows) and select top_k
+            matches = store.search(
+                query_embedding,
+                int(top_k),
+                threshold,
+                nprobe=arguments.get("nprobe"),
+                exact=arguments.get("exact", False),
+                metadata_filter=arguments.get("filter"),
+                rerank=int(arguments.get("rerank", VECTOR_RERANK)),
+            )
+            results = format_matches(store, matches)
             
             return [TextContent(type="text", text=json.dumps(results, indent=2))]
         
+        elif name == "vector_search_batch":
+            store = get_collection(arguments.get("collection"))
+            queries = arguments["queries"]
+            if "embeddings" in arguments:
+                query_embeddings = arguments["embeddings"]
+                if len(query_embeddings) != len(queries):
+                    raise ValueError("embeddings must have one entry per query")
+            else:
+                query_embeddings = await generate_embeddings(queries)
+            all_matches = store.search_many(
+                query_embeddings,
+                int(arguments.get("top_k", 5)),
+                arguments.get("threshold"),
+                nprobe=arguments.get("nprobe"),
+                exact=arguments.get("exact", False),
+                metadata_filter=arguments.get("filter"),
+                rerank=int(arguments.get("rerank", VECTOR_RERANK)),
+            )
+            results = [
+                {"query": query, "results": format_matches(store, matches)}
+                for query, matches in zip(queries, all_matches)
+            ]
+            return [TextContent(type="text", text=json.dumps(results, indent=2))]
+        
+        elif name == "vector_hybrid_search":
+            store = get_collection(arguments.get("collection"))
+            query = arguments["query"]
+            fused = store.hybrid_search(
+                query,
+                await generate_embedding(query),
+                int(arguments.get("top_k", 5)),
+                candidates=int(arguments.get("candidates", 50)),
+                vector_weight=arguments.get("vector_weight", 1.0),
+                lexical_weight=arguments.get("lexical_weight", 1.0),
+                metadata_filter=arguments.get("filter"),
+            )
+            for entry in fused:
+                doc = store.docs[entry["id"]]
+                entry["text"] = doc["text"]
+                entry["metadata"] = doc.get("metadata", {})
+            return [TextContent(type="text", text=json.dumps(fused, indent=2))]
+        
+        elif name == "vector_ingest":
+            if ("text" in arguments) == ("path" in arguments):
+                raise ValueError("Provide exactly one of text or path")
+            if "path" in arguments:
+                blocks = read_blocks(arguments["path"])
+            else:
+                blocks = text_blocks(arguments["text"])
+            report = await ingest_document(
+                get_collection(arguments.get("collection"), create=True),
+                arguments["id"],
+                blocks,
+                metadata=arguments.get("metadata"),
+                chunk_size=int(arguments.get("chunk_size", INGEST_CHUNK_SIZE)),
+                overlap=int(arguments.get("chunk_overlap", INGEST_CHUNK_OVERLAP)),
+                batch_size=max(1, int(arguments.get("batch_size", INGEST_BATCH_SIZE))),
+            )
+            return [TextContent(type="text", text=json.dumps(report, indent=2))]
+        
         elif name == "vector_get_embedding":
             text = arguments["text"]
             embedding = await generate_embedding(text)
-            return [TextContent(type="text", text=json.dumps({"embedding": embedding, "dimension": len(embedding)}, indent=2))]
+            return [TextContent(type="text", text=json.dumps({"embedding": embedding.tolist(), "dimension": len(embedding)}, indent=2))]
         
         elif name == "vector_delete":
             doc_id = arguments["id"]
-            if doc_id in vector_store:
-                del vector_store[doc_id]
+            if get_collection(arguments.get("collection")).delete(doc_id):
                 return [TextContent(type="text", text=json.dumps({"status": "deleted", "id": doc_id}, indent=2))]
             else:
                 return [TextContent(type="text", text=json.dumps({"status": "not_found", "id": doc_id}, indent=2))]
         
         elif name == "vector_list":
-            limit = arguments.get("limit", 100)
-            docs = [
-                {
-                    "id": doc["id"],
-                    "text": doc["text"][:100] + "..." if len(doc["text"]) > 100 else doc["text"],
-                    "metadata": doc.get("metadata", {}),
-                }
-                for doc in list(vector_store.values())[:limit]
-            ]
-            return [TextContent(type="text", text=json.dumps(docs, indent=2))]
+            store = get_collection(arguments.get("collection"))
+            mode = arguments.get("mode", "documents")
+            if mode == "count":
+                return [TextContent(type="text", text=json.dumps({"count": len(store)}, indent=2))]
+            if mode == "stats":
+                return [TextContent(type="text", text=json.dumps(store.stats(), indent=2))]
+            if mode != "documents":
+                raise ValueError(f"Unknown list mode: {mode}")
+            cursor = arguments.get("cursor")
+            try:
+                after = int(cursor) if cursor not in (None, "") else None
+            except ValueError:
+                raise ValueError(f"Invalid cursor: {cursor}")
+            fields = arguments.get("fields") or ["id", "text", "metadata"]
+            doc_ids, next_cursor = store.list_page(after, max(1, int(arguments.get("limit", 100))))
+            docs = []
+            for doc_id in doc_ids:
+                doc = store.docs[doc_id]
+                entry = {}
+                if "id" in fields:
+                    entry["id"] = doc_id
+                if "text" in fields:
+                    entry["text"] = doc["text"][:100] + "..." if len(doc["text"]) > 100 else doc["text"]
+                if "metadata" in fields:
+                    entry["metadata"] = doc.get("metadata", {})
+                docs.append(entry)
+            page = {"documents": docs, "next_cursor": None if next_cursor is None else str(next_cursor)}
+            return [TextContent(type="text", text=json.dumps(page, indent=2))]
+        
+        elif name == "vector_cache_stats":
+            return [TextContent(type="text", text=json.dumps(embeddings_cache.stats(), indent=2))]
+        
+        elif name == "vector_index_stats":
+            store = get_collection(arguments.get("collection"))
+            queries = None
+            if arguments.get("queries"):
+                queries = await generate_embeddings(arguments["queries"])
+            stats = store.index_stats(
+                k=int(arguments.get("k", 10)),
+                samples=int(arguments.get("samples", 100)),
+                nprobe=arguments.get("nprobe"),
+                queries=queries,
+                rerank=int(arguments.get("rerank", VECTOR_RERANK)),
+            )
+            return [TextContent(type="text", text=json.dumps(stats, indent=2))]
+        
+        elif name == "vector_find_duplicates":
+            store = get_collection(arguments.get("collection"))
+            documents = len(store)
+            clusters = store.duplicate_clusters(float(arguments.get("threshold", DEDUP_THRESHOLD)))
+            duplicates = sum(len(cluster) - 1 for cluster in clusters)
+            deleted = 0
+            if arguments.get("delete", False):
+                for cluster in clusters:
+                    deleted += sum(1 for doc_id in cluster[1:] if store.delete(doc_id))
+            result = {
+                "documents": documents,
+                "clusters": len(clusters),
+                "duplicates": duplicates,
+                "duplicate_fraction": round(duplicates / documents, 4) if documents else 0.0,
+                "deleted": deleted,
+                "groups": [{"keep": cluster[0], "duplicates": cluster[1:]} for cluster in clusters[:int(arguments.get("limit", 100))]],
+            }
+            return [TextContent(type="text", text=json.dumps(result, indent=2))]
+        
+        elif name == "vector_create_collection":
+            collection = arguments["name"]
+            create_collection(collection, arguments)
+            return [TextContent(type="text", text=json.dumps({"status": "created", "name": collection, **collection_configs[collection]}, indent=2))]
+        
+        elif name == "vector_drop_collection":
+            collection = arguments["name"]
+            status = "dropped" if drop_collection(collection) else "not_found"
+            return [TextContent(type="text", text=json.dumps({"status": status, "name": collection}, indent=2))]
+        
+        elif name == "vector_collection_stats":
+            names = [arguments["name"]] if arguments.get("name") else sorted(collections)
+            stats = [{"name": collection, **get_collection(collection).stats()} for collection in names]
+            return [TextContent(type="text", text=json.dumps(stats[0] if arguments.get("name") else stats, indent=2))]
         
         else:
             raise ValueError(f"Unknown tool: {name}")
@@ -199,8 +2667,14 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent]:
 
 async def main():
     """Main entry point"""
-    async with stdio_server() as (read_stream, write_stream):
-        await server.run(read_stream, write_stream, server.create_initialization_options())
+    try:
+        async with stdio_server() as (read_stream, write_stream):
+            await server.run(read_stream, write_stream, server.create_initialization_options())
+    finally:
+        for store in collections.values():
+            store.close()
+        if search_pool is not None:
+            search_pool.close()
 
 
 if __name__ == "__main__":